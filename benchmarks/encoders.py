@@ -0,0 +1,63 @@
+"""Compare the JSON encoders on the test models.
+
+Usage: python -m appengineserene.benchmarks.encoders [--rows N] [--repeat N]
+"""
+import argparse
+import timeit
+
+from google.appengine.api import users
+from google.appengine.ext import db, testbed
+
+import appenginejson
+
+from appengineserene.encoders import encoders
+from appengineserene.tests.models import ProjectDummy, StoryDummy, ScrumStoryDummy
+from appengineserene.utils import flatten_to_dict
+
+
+def make_rows(rows):
+    owner = users.User('mouse@lemur.com', _user_id='114818323877301381352')
+    projects = [ProjectDummy(key=db.Key.from_path('ProjectDummy', i + 1), number=i, name='Project %d' % i,
+                             description='The round fruit of a tree of the rose family.', owner=owner)
+                for i in xrange(rows)]
+    scrum_stories = []
+    for i in xrange(rows):
+        story = StoryDummy(key=db.Key.from_path('StoryDummy', i + 1), number=i, title='Eat an apple a day')
+        scrum_story = ScrumStoryDummy(key=db.Key.from_path('ScrumStoryDummy', i + 1), story=story, status='ToDo')
+        scrum_stories.append(flatten_to_dict(scrum_story, ('story',)))
+    return {'projects': projects, 'scrum_stories': scrum_stories}
+
+def run(rows, repeat):
+    results = []
+    for payload_name, payload in sorted(make_rows(rows).items()):
+        expected = appenginejson.loads(appenginejson.dumps(payload))
+        for encoder_name, encoder in sorted(encoders.items()):
+            assert appenginejson.loads(encoder.dumps(payload)) == expected, (payload_name, encoder_name)
+            seconds = min(timeit.repeat(lambda: encoder.dumps(payload), number=1, repeat=repeat))
+            results.append((payload_name, encoder_name, seconds))
+    return results
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('--rows', type=int, default=1000)
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_user_stub()
+    try:
+        results = run(args.rows, args.repeat)
+    finally:
+        bed.deactivate()
+
+    baselines = dict(((payload_name, seconds) for payload_name, encoder_name, seconds in results
+                      if encoder_name == 'appenginejson'))
+    for payload_name, encoder_name, seconds in results:
+        print '%-14s %-14s %8.2f ms %6.2fx' % (payload_name, encoder_name, seconds * 1000,
+                                               baselines[payload_name] / seconds)
+
+
+if __name__ == '__main__':
+    main()
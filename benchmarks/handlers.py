@@ -0,0 +1,216 @@
+"""Benchmark the handler stack against the test app on seeded datastores.
+
+Usage: python -m appengineserene.benchmarks.handlers [--sizes 1000,10000,100000] [--requests N] [--seed N]
+                                                     [--output FILE] [--compare BASE.json]
+
+Each route is requested --requests times per dataset size, in a process forked from the seeded one, recording
+latency percentiles, throughput, datastore RPCs per request and that process' peak resident memory. Results are
+written as JSON with stable ordering so the files from two revisions can be diffed, or compared directly with
+--compare.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+import webtest
+from google.appengine.ext import db, testbed
+
+import appenginejson
+
+from appengineserene import profiling
+from appengineserene.tests.models import ProjectDummy, StoryDummy, ScrumStoryDummy
+from appengineserene.tests.urls import app
+
+
+PAGE_SIZE = 100
+PUT_BATCH_SIZE = 500
+STORY_PARENTS = 10
+
+DESCRIPTION = 'The round fruit of a tree of the rose family.'
+
+
+def seed(size):
+    """Put ``size`` projects, stories (spread over the first few projects) and scrum stories.
+    """
+    project_keys = []
+    for start in xrange(0, size, PUT_BATCH_SIZE):
+        project_keys.extend(db.put([ProjectDummy(number=i, name='Project %d' % i, description=DESCRIPTION)
+                                    for i in xrange(start, min(start + PUT_BATCH_SIZE, size))]))
+    story_keys = []
+    for start in xrange(0, size, PUT_BATCH_SIZE):
+        story_keys.extend(db.put([StoryDummy(parent=project_keys[i % STORY_PARENTS], number=i,
+                                             title='Eat an apple a day')
+                                  for i in xrange(start, min(start + PUT_BATCH_SIZE, size))]))
+    scrum_story_keys = []
+    for start in xrange(0, size, PUT_BATCH_SIZE):
+        scrum_story_keys.extend(db.put([ScrumStoryDummy(story=story_keys[i], status='ToDo')
+                                        for i in xrange(start, min(start + PUT_BATCH_SIZE, size))]))
+    return {'projects': project_keys, 'stories': story_keys, 'scrum_stories': scrum_story_keys}
+
+def get_routes(keys, rng):
+    """Return (name, request factory, max requests) triples; each factory returns (method, url, body).
+    """
+    project_keys = keys['projects']
+    # Deletes consume keys from the back half so they never remove an entity the lookups may still pick.
+    lookup_count = max(len(project_keys) // 2, 1)
+    doomed_keys = list(reversed(project_keys[lookup_count:]))
+
+    def random_key(name):
+        return str(rng.choice(keys[name][:lookup_count]))
+
+    def project_kwargs():
+        number = rng.randint(0, 1000000)
+        return {'number': number, 'name': 'Project %d' % number, 'description': DESCRIPTION}
+
+    routes = [
+        ('list_projects', lambda: ('GET', '/projects?limit=%d' % PAGE_SIZE, None)),
+        ('list_projects_filtered', lambda: ('GET', '/projects?limit=%d&number__gte=%d'
+                                            % (PAGE_SIZE, rng.randint(0, len(project_keys))), None)),
+        ('list_stories', lambda: ('GET', '/projects/%s/stories?limit=%d'
+                                  % (project_keys[rng.randrange(min(STORY_PARENTS, len(project_keys)))],
+                                     PAGE_SIZE), None)),
+        ('list_scrum_stories_expanded', lambda: ('GET', '/scrum/stories?limit=%d' % PAGE_SIZE, None)),
+        ('get_project', lambda: ('GET', '/projects/%s' % random_key('projects'), None)),
+        ('get_scrum_story_expanded', lambda: ('GET', '/scrum/stories/%s' % random_key('scrum_stories'), None)),
+        ('create_project', lambda: ('POST', '/projects', project_kwargs())),
+        ('create_scrum_story_expanded', lambda: ('POST', '/scrum/stories',
+                                                 {'number': 1, 'title': 'Grow an apple tree', 'status': 'ToDo'})),
+        ('update_project', lambda: ('PUT', '/projects/%s' % random_key('projects'), project_kwargs())),
+        ('update_scrum_story_expanded', lambda: ('PUT', '/scrum/stories/%s' % random_key('scrum_stories'),
+                                                 {'title': 'Throw an apple away', 'status': 'Done'})),
+    ]
+    limits = {'delete_project': len(doomed_keys)}
+    routes.append(('delete_project', lambda: ('DELETE', '/projects/%s' % doomed_keys.pop(), None)))
+    return [(name, factory, limits.get(name)) for name, factory in routes]
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def measure(testapp, factory, requests):
+    latencies = []
+    rpcs = 0
+    for i in xrange(requests):
+        method, url, body = factory()
+        kwargs = {'method': method, 'expect_errors': True}
+        if body is not None:
+            kwargs.update(body=appenginejson.dumps(body), content_type='application/json')
+        profile = profiling.start()
+        started = time.time()
+        try:
+            response = testapp.request(url, **kwargs)
+        finally:
+            elapsed = time.time() - started
+            profiling.stop()
+        if response.status_int >= 400:
+            raise AssertionError('%s %s returned %s: %s' % (method, url, response.status, response.body))
+        latencies.append(elapsed)
+        rpcs += profile.rpcs.get('datastore_v3', 0)
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput_rps': round(requests / sum(latencies), 3),
+        'latency_ms': dict((name, round(percentile(latencies, fraction) * 1000, 3))
+                           for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))),
+        'datastore_rpcs_per_request': round(float(rpcs) / requests, 3),
+    }
+
+def measure_forked(testapp, factory, requests):
+    """Run measure() in a child forked from the seeded process and add the child's peak resident memory.
+
+    Every route starts from the same seeded state, so its peak does not depend on the routes run before it.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(measure(testapp, factory, requests), pipe)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    if status:
+        raise AssertionError('measuring in child %d failed with status %d' % (pid, status))
+    result = json.loads(output)
+    # ru_maxrss is in kilobytes on Linux.
+    result['peak_rss_kb'] = rusage.ru_maxrss
+    return result
+
+def run(sizes, requests, seed_value):
+    results = []
+    for size in sizes:
+        bed = testbed.Testbed()
+        bed.activate()
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        bed.init_taskqueue_stub()
+        bed.init_user_stub()
+        try:
+            started = time.time()
+            keys = seed(size)
+            print >> sys.stderr, 'seeded %d entities per model in %.1fs' % (size, time.time() - started)
+
+            rng = random.Random(seed_value)
+            testapp = webtest.TestApp(app)
+            for route, factory, limit in get_routes(keys, rng):
+                count = requests if limit is None else min(requests, limit)
+                if not count:
+                    continue
+                result = measure_forked(testapp, factory, count)
+                result.update(size=size, route=route)
+                results.append(result)
+                print >> sys.stderr, '%7d %-30s p50 %8.2f ms  %7.1f req/s  %5.1f RPCs' % (
+                    size, route, result['latency_ms']['p50'], result['throughput_rps'],
+                    result['datastore_rpcs_per_request'])
+        finally:
+            bed.deactivate()
+    return results
+
+def compare(base, head):
+    """Print (to stderr) the head/base ratio of p50 latency and RPCs for every (size, route) in both result files.
+    """
+    base_results = dict(((result['size'], result['route']), result) for result in base['results'])
+    for result in head['results']:
+        base_result = base_results.get((result['size'], result['route']))
+        if base_result is None:
+            continue
+        print >> sys.stderr, '%7d %-30s p50 %6.2fx  RPCs %6.2fx' % (
+            result['size'], result['route'],
+            result['latency_ms']['p50'] / (base_result['latency_ms']['p50'] or 1),
+            result['datastore_rpcs_per_request'] / (base_result['datastore_rpcs_per_request'] or 1))
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('--sizes', default='1000,10000,100000',
+                           type=lambda value: [int(size) for size in value.split(',')])
+    argparser.add_argument('--requests', type=int, default=50)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    argparser.add_argument('--compare', type=argparse.FileType('r'))
+    args = argparser.parse_args()
+
+    report = {
+        'config': {'sizes': args.sizes, 'requests': args.requests, 'seed': args.seed, 'page_size': PAGE_SIZE},
+        'python': sys.version.split()[0],
+        'results': run(args.sizes, args.requests, args.seed),
+    }
+    json.dump(report, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+    if args.compare:
+        compare(json.load(args.compare), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Compare to_dict / flatten_to_dict against the original implementations they replaced.
+
+Usage: python -m appengineserene.benchmarks.serializers [--rows N] [--repeat N]
+"""
+import argparse
+import timeit
+
+from google.appengine.api import users
+from google.appengine.ext import db, testbed
+
+from appengineserene.tests.models import ProjectDummy, StoryDummy, ScrumStoryDummy
+from appengineserene.utils import flatten_to_dict, to_dict
+
+
+# The original implementations, copied verbatim from utils.py as it stood before the schema-based rewrite.
+def original_to_dict(model_instance, recursive=False):
+    dictionary = {'key': unicode(model_instance.key())}
+    for key, prop in model_instance.properties().items():
+        value = getattr(model_instance, key)
+        if isinstance(prop, db.ReferenceProperty):
+            dictionary[key] = original_to_dict(value) if recursive else value
+        else:
+            dictionary[key] = value
+    return dictionary
+
+def original_flatten_to_dict(model_instance, flatten_keys):
+    model_instance_dict = original_to_dict(model_instance)
+    dictionary = {}
+    for key in reversed(flatten_keys):
+        dictionary.update(original_to_dict(model_instance_dict.pop(key)))
+    dictionary.update(model_instance_dict)
+    return dictionary
+
+def make_rows(rows):
+    owner = users.User('mouse@lemur.com', _user_id='114818323877301381352')
+    projects = [ProjectDummy(key=db.Key.from_path('ProjectDummy', i + 1), number=i, name='Project %d' % i,
+                             description='The round fruit of a tree of the rose family.', owner=owner)
+                for i in xrange(rows)]
+    scrum_stories = []
+    for i in xrange(rows):
+        story = StoryDummy(key=db.Key.from_path('StoryDummy', i + 1), number=i, title='Eat an apple a day')
+        scrum_stories.append(ScrumStoryDummy(key=db.Key.from_path('ScrumStoryDummy', i + 1), story=story,
+                                             status='ToDo'))
+    return projects, scrum_stories
+
+def run(rows, repeat):
+    projects, scrum_stories = make_rows(rows)
+    cases = [
+        ('to_dict', lambda: [original_to_dict(project) for project in projects],
+         lambda: [to_dict(project) for project in projects]),
+        ('flatten_to_dict',
+         lambda: [original_flatten_to_dict(scrum_story, ('story',)) for scrum_story in scrum_stories],
+         lambda: [flatten_to_dict(scrum_story, ('story',)) for scrum_story in scrum_stories]),
+    ]
+    results = []
+    for name, original, schema in cases:
+        assert original() == schema(), name
+        results.append((name,
+                        min(timeit.repeat(original, number=1, repeat=repeat)),
+                        min(timeit.repeat(schema, number=1, repeat=repeat))))
+    return results
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument('--rows', type=int, default=10000)
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_user_stub()
+    try:
+        results = run(args.rows, args.repeat)
+    finally:
+        bed.deactivate()
+
+    for name, original_seconds, schema_seconds in results:
+        print '%-16s original %8.2f ms  schema %8.2f ms %6.2fx' % (name, original_seconds * 1000,
+                                                                  schema_seconds * 1000,
+                                                                  original_seconds / schema_seconds)
+
+
+if __name__ == '__main__':
+    main()
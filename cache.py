@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+
+GENERATION_KEY = 'generation'
+LEASE_PREFIX = 'lease:'
+
+
+class LRUCache(object):
+    """Thread-safe in-process LRU cache with per-entry expiry.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires and expires < time.time():
+                return None
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=0):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl if ttl else 0, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SingleFlight(object):
+    """In-process registry of the keys being rebuilt, so identical requests wait instead of repeating the work.
+    """
+    def __init__(self):
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """Return (True, event) if the caller now leads the flight for ``key``, else (False, leader's event).
+        """
+        with self._lock:
+            event = self._events.get(key)
+            if event is not None:
+                return False, event
+            event = self._events[key] = threading.Event()
+            return True, event
+
+    def end(self, key):
+        with self._lock:
+            event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+
+local_cache = LRUCache()
+local_generations = {}
+single_flight = SingleFlight()
+
+
+def get_generation(namespace):
+    generation = memcache.get(GENERATION_KEY, namespace=namespace)
+    if generation is None:
+        generation = int(time.time() * 1000)
+        if not memcache.add(GENERATION_KEY, generation, namespace=namespace):
+            generation = memcache.get(GENERATION_KEY, namespace=namespace)
+    if generation is None:
+        # Memcache is unavailable, so only this instance's own writes can invalidate.
+        generation = 'local%d' % local_generations.get(namespace, 0)
+    return generation
+
+def get_generations(namespaces):
+    """Combine the generations of ``namespaces``, so that invalidating any one of them changes the result.
+    """
+    return '.'.join(str(get_generation(namespace)) for namespace in namespaces)
+
+def get(namespace, key, generation=None):
+    if generation is None:
+        generation = get_generation(namespace)
+    key = '%s:%s' % (generation, key)
+    value = local_cache.get((namespace, key))
+    if value is None:
+        value = memcache.get(key, namespace=namespace)
+    return value
+
+def set(namespace, key, value, ttl=0, generation=None):
+    """Store ``value`` under ``generation``, which should be read before ``value`` was built so that a value built
+    from data an invalidation has since replaced is never stored as current.
+    """
+    if generation is None:
+        generation = get_generation(namespace)
+    key = '%s:%s' % (generation, key)
+    local_cache.set((namespace, key), value, ttl)
+    memcache.set(key, value, time=ttl, namespace=namespace)
+
+def invalidate(namespace):
+    local_generations[namespace] = local_generations.get(namespace, 0) + 1
+    memcache.incr(GENERATION_KEY, namespace=namespace, initial_value=int(time.time() * 1000))
+
+def acquire_lease(namespace, key, ttl):
+    """Elect one instance to rebuild ``key``; the lease lapses after ``ttl`` seconds if it is never released.
+    """
+    return memcache.add(LEASE_PREFIX + key, 1, time=int(math.ceil(ttl)), namespace=namespace)
+
+def release_lease(namespace, key):
+    memcache.delete(LEASE_PREFIX + key, namespace=namespace)
@@ -1,12 +1,28 @@
+import collections
+import copy
+import hashlib
+import itertools
+import random
+import time
+import urllib
+import zlib
+from datetime import datetime
+
 import webapp2
 from google.appengine.ext import db
 
 import appenginejson
 from appenginevalidation import clean
 
-from appengineserene.errors import Http4xx
-from appengineserene.parsers import parse
-from appengineserene.utils import flatten_to_dict
+from appengineserene import cache, profiling, tasks
+from appengineserene.encoders import get_encoder
+from appengineserene.errors import ContentTypeNotSupportedError, Http4xx
+from appengineserene.parsers import JsonArrayIterator, parse
+from appengineserene.properties import (SnapshotProperty, defer_sync, get_snapshot_name, get_snapshot_state,
+                                        resolve_snapshots)
+from appengineserene.renderers import JsonRenderer, negotiate
+from appengineserene.utils import (allocate_keys, coerce_value, flatten_to_dict, get_sort_key, iter_batches,
+                                   iter_prefetched, merge_sorted, prefetch_references, to_dict)
 
 
 class BaseHandler(webapp2.RequestHandler):
@@ -14,24 +30,458 @@ class BaseHandler(webapp2.RequestHandler):
     parent_model = None
     group_property = None
     expanded_properties = ()
+    embedded_properties = ()
+    transactional = False
+    shard_count = None
+    shard_property = None
+    max_body_size = None
+    encoder = None
+    cache_ttl = None
+    cache_namespace = None
+    cached_headers = ('Link', 'ETag', 'Last-Modified')
+    coalesce_timeout = None
+    coalesce_poll_interval = 0.05
+    cache_generation = None
+    use_etags = False
+    last_modified_property = 'updated'
+    allowed_fields = None
+    compress_threshold = None
+    compress_level = 6
+    content_encodings = ('gzip', 'deflate')
+    profile_hooks = ()
+    deferred_methods = ()
+    defer_cascades = False
+    task_status_route = None
+    profile = profiling.NULL_PROFILE
 
     def _method(self, do_method, success_status=None, parse_method=None, *args, **kwargs):
-        if parse_method:
-            parse_method(self.request)
+        if not self.profile_hooks:
+            return self._respond(do_method, success_status, parse_method, *args, **kwargs)
+        self.profile = profiling.start()
+        try:
+            self._respond(do_method, success_status, parse_method, *args, **kwargs)
+        finally:
+            profiling.stop()
+            for hook in self.profile_hooks:
+                hook(self, self.profile)
+
+    def _respond(self, do_method, success_status=None, parse_method=None, *args, **kwargs):
+        cacheable = self.cache_ttl is not None and self.request.method == 'GET'
+        if cacheable and self.respond_cached():
+            return
+        if not (cacheable and self.coalesce_timeout):
+            return self._build_response(cacheable, do_method, success_status, parse_method, *args, **kwargs)
+
+        end_flight = self.coalesce()
+        if end_flight is None:
+            return
+        try:
+            self._build_response(cacheable, do_method, success_status, parse_method, *args, **kwargs)
+        finally:
+            end_flight()
+
+    def _build_response(self, cacheable, do_method, success_status=None, parse_method=None, *args, **kwargs):
+        conditional = False
         try:
-            result = do_method(*args, **kwargs)
+            if parse_method:
+                with self.profile.phase('parse'):
+                    parse_method(self.request, self.max_body_size)
+            with self.profile.phase('do_method'):
+                result = self.call(do_method, *args, **kwargs)
         except db.BadKeyError:
             self.error(404)
             self.response.out.write(appenginejson.dumps('Error 404 Not Found'))
+        except ContentTypeNotSupportedError:
+            self.error(415)
+            self.response.out.write(appenginejson.dumps('Error 415 Unsupported Media Type'))
         except Http4xx as e:
             self.error(e.status_code)
             self.response.out.write(appenginejson.dumps(e.message))
         else:
-            if success_status:
+            # Every write invalidates, cached or not, since other handlers may cache the kinds written here.
+            if self.request.method not in ('GET', 'HEAD'):
+                self.invalidate_cache()
+            if success_status and self.response.status_int == 200:
                 self.response.set_status(success_status)
-            self.response.out.write(appenginejson.dumps(result))
+            conditional = self.use_etags and self.request.method == 'GET' and self.response.status_int == 200
+            if conditional:
+                self.response.etag, self.response.last_modified = self.get_validators(result)
+                if self.response.etag and self.is_not_modified():
+                    self.respond_conditionally()
+                    return
+            etag = self.write_result(result, digest=conditional and not self.response.etag)
+            if etag:
+                self.response.etag = etag
+            if conditional and self.response.content_encoding:
+                self.response.etag = '%s-%s' % (self.response.etag, self.response.content_encoding)
+            if cacheable and self.response.status_int == 200:
+                self.set_cached()
+            if conditional:
+                self.respond_conditionally()
+            return
         self.response.headers['Content-Type'] = 'application/json'
 
+    def call(self, do_method, *args, **kwargs):
+        """Run ``do_method`` now, or hand it to a task and answer 202 if it is listed in deferred_methods.
+        """
+        if do_method.__name__ not in self.deferred_methods:
+            return do_method(*args, **kwargs)
+        self.check_deferred(do_method.__name__)
+        return self.respond_deferred(tasks.defer_handler_method(self, do_method.__name__, args, kwargs))
+
+    def check_deferred(self, method_name):
+        """Validate the request before ``method_name`` is deferred, so that a bad one still gets its 4xx at once.
+        """
+        pass
+
+    def respond_deferred(self, status):
+        self.response.set_status(202)
+        if self.task_status_route:
+            self.response.headers['Location'] = self.uri_for(self.task_status_route, key=str(status.key()),
+                                                             _full=True)
+        return to_dict(status)
+
+    def get_validators(self, result):
+        last_modified = None
+        if self.last_modified_property and isinstance(result, db.Model):
+            last_modified = getattr(result, self.last_modified_property, None)
+        if not isinstance(last_modified, datetime):
+            return None, None
+        # The ETag names a representation, so it also covers the negotiated media type and the selected fields.
+        etag = hashlib.md5('%s:%s:%s:%s' % (result.key(), last_modified.isoformat(),
+                                            self.get_renderer(result).media_type,
+                                            ','.join(sorted(self.get_fields() or ())))).hexdigest()
+        return etag, last_modified
+
+    def get_etag(self, result):
+        etag, last_modified = self.get_validators(result)
+        return etag or hashlib.md5(self.serialize(result)).hexdigest()
+
+    def get_etag_variants(self, etag):
+        # Compressed representations carry the content coding as an ETag suffix.
+        return [etag] + ['%s-%s' % (etag, encoding) for encoding in self.content_encodings]
+
+    def is_not_modified(self):
+        if 'If-None-Match' in self.request.headers:
+            etag = self.response.etag
+            if self.response.content_encoding:
+                return etag in self.request.if_none_match
+            # Not compressed yet, so only the coding this request negotiated may match.
+            encoding = self.get_content_encoding()
+            variants = [etag] + (['%s-%s' % (etag, encoding)] if encoding else [])
+            return any(variant in self.request.if_none_match for variant in variants)
+        if_modified_since = self.request.if_modified_since
+        last_modified = self.response.last_modified
+        return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+    def respond_conditionally(self):
+        if self.response.status_int == 200 and self.is_not_modified():
+            self.response.set_status(304)
+            self.response.clear()
+            self.response.headers.pop('Content-Type', None)
+            self.response.headers.pop('Content-Encoding', None)
+
+    def check_if_match(self, model_instance):
+        if 'If-Match' not in self.request.headers:
+            return
+        if model_instance is None or not any(variant in self.request.if_match for variant in
+                                             self.get_etag_variants(self.get_etag(self.represent(model_instance)))):
+            raise Http4xx(412, 'Precondition Failed')
+
+    def get_cache_namespace(self):
+        return self.cache_namespace or self.model.kind()
+
+    def get_cache_key(self):
+        return hashlib.sha1('%s:%s:%s:%s' % (self.__class__.__name__, negotiate(self.request).media_type,
+                                             self.get_content_encoding(), self.request.path_qs)).hexdigest()
+
+    def respond_cached(self):
+        if not self.write_cached():
+            return False
+        if self.use_etags:
+            self.respond_conditionally()
+        return True
+
+    def coalesce(self):
+        """Wait for an identical request that is already rebuilding this response, in this instance or another.
+
+        Returns None when the response turned up in the cache meanwhile and has been written, otherwise a function
+        that ends this request's flight once it has rebuilt the response itself. Waits are bounded by
+        coalesce_timeout; a request whose wait runs out still takes the lease when it can before rebuilding, so a
+        stalled flight is not followed by every waiter rebuilding at once.
+        """
+        namespace = self.get_cache_namespace()
+        cache_key = self.get_cache_key()
+        leader, event = cache.single_flight.begin(cache_key)
+        if not leader and event.wait(self.coalesce_timeout):
+            # The flight in this instance finished; rebuild only if it failed to cache the response.
+            return None if self.respond_cached() else (lambda: None)
+
+        # The lease outlives the wait, so other instances stop waiting before it expires under a slow rebuild.
+        lease_ttl = 2 * self.coalesce_timeout
+        deadline = time.time() + self.coalesce_timeout
+        leased = cache.acquire_lease(namespace, cache_key, lease_ttl)
+        while not leased and time.time() < deadline:
+            time.sleep(self.coalesce_poll_interval)
+            if self.respond_cached():
+                if leader:
+                    cache.single_flight.end(cache_key)
+                return None
+            leased = cache.acquire_lease(namespace, cache_key, lease_ttl)
+
+        def end_flight():
+            if leased:
+                cache.release_lease(namespace, cache_key)
+            if leader:
+                cache.single_flight.end(cache_key)
+        return end_flight
+
+    def write_cached(self):
+        # A miss records the generation, so set_cached stores the response under the one it is being built from.
+        namespace = self.get_cache_namespace()
+        self.cache_generation = cache.get_generations(self.get_cache_namespaces())
+        cached = cache.get(namespace, self.get_cache_key(), self.cache_generation)
+        if cached is None:
+            return False
+        headers, body = cached
+        for name, value in headers:
+            self.response.headers[name] = value
+        self.response.out.write(body)
+        return True
+
+    def set_cached(self):
+        headers = [(name, self.response.headers[name])
+                   for name in ('Content-Type', 'Content-Encoding', 'Vary') + self.cached_headers
+                   if name in self.response.headers]
+        cache.set(self.get_cache_namespace(), self.get_cache_key(), (headers, self.response.body), self.cache_ttl,
+                  self.cache_generation)
+
+    def get_cache_namespaces(self):
+        """Namespaces whose generations a cached response depends on: every kind it is built from, plus
+        cache_namespace when set.
+        """
+        namespaces = [self.model.kind()] + [expanded_model.kind() for expanded_model in self.get_expanded_models()]
+        if self.cache_namespace:
+            namespaces.append(self.cache_namespace)
+        return namespaces
+
+    def invalidate_cache(self):
+        for namespace in self.get_cache_namespaces():
+            cache.invalidate(namespace)
+
+    def get_expanded_models(self):
+        return [getattr(self.model, prop_name).reference_class for prop_name in self.expanded_properties]
+
+    def get_parent_model(self):
+        if self.group_property:
+            return self.model.properties()[self.group_property].reference_class
+        return self.parent_model
+
+    def get_parent_async(self, parent_key):
+        parent_model = self.get_parent_model()
+        if parent_model is None:
+            return None, None
+        parent_key = db.Key(parent_key)
+        if parent_key.kind() != parent_model.kind():
+            raise Http4xx(404, 'Error 404 Not Found')
+        return parent_key, db.get_async(parent_key)
+
+    def get_scope_keys(self, parent_key):
+        """Ancestors holding the collection: the parent itself, or when sharded, shard_count synthetic root keys
+        so that writes to one parent are spread over that many entity groups.
+        """
+        if not (self.shard_count and self.parent_model):
+            return [parent_key]
+        return [db.Key.from_path('%sShard' % self.model.kind(), '%s:%d' % (parent_key, index))
+                for index in xrange(self.shard_count)]
+
+    def check_parent(self, parent_rpc):
+        if parent_rpc is not None and parent_rpc.get_result() is None:
+            raise Http4xx(404, 'Error 404 Not Found')
+
+    def get_encoder(self):
+        return get_encoder(self.encoder)
+
+    def get_renderer(self, result):
+        renderer = negotiate(self.request)
+        return renderer if renderer.accepts(self, result) else JsonRenderer
+
+    def serialize(self, result):
+        return self.get_renderer(result).render(self, result)
+
+    def get_content_encoding(self):
+        if self.compress_threshold is None or 'Accept-Encoding' not in self.request.headers:
+            return None
+        return self.request.accept_encoding.best_match(self.content_encodings)
+
+    def get_compressor(self, encoding):
+        if encoding == 'gzip':
+            return zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return zlib.compressobj(self.compress_level)
+
+    def write_result(self, result, digest=False):
+        """Render ``result`` into the response, returning the MD5 of the uncompressed body if ``digest``.
+
+        Bodies are only compressed once they grow past compress_threshold, so streamed lists are compressed
+        chunk by chunk without first being buffered whole. Time spent producing chunks (including lazy query
+        fetches for streamed lists) is profiled as 'serialize', the rest as 'write'.
+        """
+        renderer = self.get_renderer(result)
+        if isinstance(result, collections.Iterator):
+            chunks = self.profile.iter_timed('serialize', renderer.render_iter(self, result))
+        else:
+            with self.profile.phase('serialize'):
+                chunks = [renderer.render(self, result)]
+        serialized = self.profile.timings.get('serialize', 0)
+        with self.profile.phase('write'):
+            encoding = self.get_content_encoding()
+            md5 = hashlib.md5() if digest else None
+            compressor = None
+            buffered = []
+            size = 0
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                if md5:
+                    md5.update(chunk)
+                if compressor:
+                    self.response.out.write(compressor.compress(chunk))
+                elif encoding:
+                    buffered.append(chunk)
+                    size += len(chunk)
+                    if size > self.compress_threshold:
+                        compressor = self.get_compressor(encoding)
+                        self.response.out.write(compressor.compress(''.join(buffered)))
+                        buffered = None
+                else:
+                    self.response.out.write(chunk)
+            if compressor:
+                self.response.out.write(compressor.flush())
+                self.response.headers['Content-Encoding'] = encoding
+            elif buffered:
+                self.response.out.write(''.join(buffered))
+        self.profile.add('write', serialized - self.profile.timings.get('serialize', 0))
+
+        self.response.headers['Content-Type'] = renderer.media_type
+        self.response.headers['Vary'] = 'Accept' if self.compress_threshold is None else 'Accept, Accept-Encoding'
+        return md5.hexdigest() if md5 else None
+
+    def represent(self, model_instance, fields=None):
+        if self.expanded_properties:
+            return flatten_to_dict(model_instance, self.expanded_properties, fields)
+        elif fields is not None:
+            return to_dict(model_instance, fields=fields)
+        else:
+            return model_instance
+
+    def get_allowed_fields(self):
+        if self.allowed_fields is not None:
+            return set(self.allowed_fields) | set(['key'])
+        allowed_fields = set(self.model.properties())
+        for expanded_model in self.get_expanded_models():
+            allowed_fields.update(expanded_model.properties())
+        return (allowed_fields - set(self.expanded_properties)) | set(['key'])
+
+    def get_fields(self):
+        fields = self.request.get('fields')
+        if not fields:
+            return None
+        fields = set(field.strip() for field in fields.split(',') if field.strip())
+        invalid_fields = fields - self.get_allowed_fields()
+        if invalid_fields:
+            raise Http4xx(400, 'Invalid fields: %s' % ', '.join(sorted(invalid_fields)))
+        return fields
+
+    def get_reference_keys(self, model_instance):
+        """Keys of the expanded references, read without dereferencing them.
+        """
+        properties = model_instance.properties()
+        reference_keys = [properties[prop_name].get_value_for_datastore(model_instance)
+                          for prop_name in self.expanded_properties]
+        return [reference_key for reference_key in reference_keys if reference_key is not None]
+
+    def update_model_instances(self, model_instance, content):
+        """Set ``content`` on ``model_instance`` and its expanded references, returning the instances to put and
+        those among them whose snapshots the update made stale.
+        """
+        cleaned_content = clean(content, self.model)
+
+        model_instances = []
+        states = []
+        if self.expanded_properties:
+            for prop_name in self.expanded_properties:
+                prop = getattr(model_instance, prop_name)
+                states.append(get_snapshot_state(prop))
+                expanded_model = getattr(self.model, prop_name).reference_class
+                expanded_content = clean(content, expanded_model)
+                for k, v in expanded_content.items():
+                    # TODO: Move 'key' check somewhere else
+                    if k != 'key':
+                        setattr(prop, k, v)
+                model_instances.append(prop)
+                cleaned_content[prop_name] = prop
+
+        states.append(get_snapshot_state(model_instance))
+        for k, v in cleaned_content.items():
+            # TODO: Move 'key' check somewhere else
+            if k != 'key':
+                setattr(model_instance, k, v)
+        self.embed_snapshots(model_instance)
+        model_instances.append(model_instance)
+        stale = [instance for instance, state in zip(model_instances, states)
+                 if state is not None and get_snapshot_state(instance) != state]
+        return model_instances, stale
+
+    def patch_model_instance(self, model_instance, content, exclude=()):
+        """Validate and set only the submitted properties, returning whether any of them changed.
+        """
+        changed = False
+        model = model_instance.__class__
+        for prop_name, prop in model_instance.properties().items():
+            if prop_name not in content or prop_name in exclude or isinstance(prop, SnapshotProperty):
+                continue
+            try:
+                # Cleaned one field at a time as PUT and POST clean it, so PATCH accepts exactly the values they do.
+                value = prop.validate(clean({prop_name: content[prop_name]}, model).get(prop_name))
+            except (db.BadValueError, db.BadKeyError, ValueError):
+                raise Http4xx(400, 'Invalid value for field: %s' % prop_name)
+            # Compare datastore values so unchanged references are never dereferenced.
+            if prop.get_value_for_datastore(model_instance) != value:
+                setattr(model_instance, prop_name, value)
+                changed = True
+        return changed
+
+    def embed_snapshots(self, model_instance):
+        for prop_name in self.embedded_properties:
+            setattr(model_instance, get_snapshot_name(self.model, prop_name), getattr(model_instance, prop_name))
+
+    def get_fetched_properties(self):
+        """Expanded properties that are not served from embedded snapshots.
+        """
+        return tuple(prop_name for prop_name in self.expanded_properties if prop_name not in self.embedded_properties)
+
+    def run_in_transaction(self, function, *args, **kwargs):
+        """Run ``function`` in a cross-group transaction if the request has an If-Match precondition or the handler
+        is transactional, so that the precondition is checked against the version of the entity that is written.
+        """
+        if 'If-Match' not in self.request.headers and not self.transactional:
+            return function(*args, **kwargs)
+        options = db.create_transaction_options(xg=True)
+        return db.run_in_transaction_options(options, function, *args, **kwargs)
+
+    def put_model_instances(self, model_instances, stale=()):
+        """Put ``model_instances``, queueing a refresh of the snapshots other entities keep of those in ``stale``.
+
+        Snapshots embedded in ``model_instances`` themselves were just refreshed, so they are not synced again.
+        """
+        if self.transactional and not db.is_in_transaction():
+            options = db.create_transaction_options(xg=True)
+            return db.run_in_transaction_options(options, self.put_model_instances, model_instances, stale)
+        keys = db.put(model_instances)
+        if stale:
+            defer_sync([model_instance.key() for model_instance in stale], model_instances)
+        return keys
+
     def get(self, *args, **kwargs):
         self._method(self.do_get, *args, **kwargs)
 
@@ -41,10 +491,14 @@ class BaseHandler(webapp2.RequestHandler):
     def put(self, *args, **kwargs):
         self._method(self.do_put, None, parse, *args, **kwargs)
 
+    def patch(self, *args, **kwargs):
+        self._method(self.do_patch, None, parse, *args, **kwargs)
+
     def delete(self, *args, **kwargs):
         self._method(self.do_delete, 204, *args, **kwargs)
         if self.response.status_int == 204:
             del self.response.headers['Content-Type']
+            self.response.headers.pop('Content-Encoding', None)
             self.response.clear()
 
     def do_get(self, *args, **kwargs):
@@ -56,6 +510,9 @@ class BaseHandler(webapp2.RequestHandler):
     def do_put(self, *args, **kwargs):
         raise NotImplementedError
 
+    def do_patch(self, *args, **kwargs):
+        raise NotImplementedError
+
     def do_delete(self, *args, **kwargs):
         raise NotImplementedError
 
@@ -63,109 +520,648 @@ class BaseHandler(webapp2.RequestHandler):
 
 class ListHandler(BaseHandler):
     order_by = ()
+    filter_fields = {}
+    filter_operators = {
+        'exact': '=',
+        'lt': '<',
+        'lte': '<=',
+        'gt': '>',
+        'gte': '>=',
+    }
+    page_size = None
+    max_page_size = 1000
+    batch_size = 100
+    projection_queries = True
+    projection_property_types = (db.IntegerProperty, db.FloatProperty, db.BooleanProperty, db.StringProperty,
+                                 db.DateTimeProperty)
+    max_query_plans = 100
+    aggregate_fields = {}
+    aggregate_functions = {
+        'sum': sum,
+        'min': min,
+        'max': max,
+    }
+    max_count = None
 
-    def do_get(self, parent_key=None, **kwargs):
-        query_str = '' if not self.order_by else 'ORDER BY ' + ', '.join(self.order_by)
+    def head(self, *args, **kwargs):
+        self._method(self.do_head, *args, **kwargs)
+        self.response.clear()
+
+    def get_filters(self):
+        # Without filter_fields, query parameters were never filters, so they are left for the client's own use.
+        if not self.filter_fields:
+            return []
+        properties = self.model.properties()
+        filters = []
+        for param, value in self.request.GET.items():
+            prop_name, _, lookup = param.partition('__')
+            if prop_name not in properties:
+                continue
+            lookup = lookup or 'exact'
+            if lookup not in self.filter_fields.get(prop_name, ()) or lookup not in self.filter_operators:
+                raise Http4xx(400, 'Invalid filter: %s' % param)
+            try:
+                value = coerce_value(properties[prop_name], value)
+            except (db.BadValueError, db.BadKeyError, ValueError):
+                raise Http4xx(400, 'Invalid value for filter: %s' % param)
+            filters.append((prop_name, self.filter_operators[lookup], value))
+
+        inequality_prop_names = set(prop_name for prop_name, operator, value in filters if operator != '=')
+        if len(inequality_prop_names) > 1:
+            raise Http4xx(400, 'Inequality filters are only allowed on one property')
+        return sorted(filters)
+
+    def get_order_by(self, filters=()):
+        for prop_name, operator, value in filters:
+            if operator != '=':
+                # The datastore requires the first sort order to be on the inequality filter property; a declared
+                # order on it keeps its direction.
+                orders = [order for order in self.order_by if order.split()[0] == prop_name] or [prop_name]
+                return tuple(orders[:1]) + tuple(order for order in self.order_by if order.split()[0] != prop_name)
+        return tuple(self.order_by)
+
+    def get_projection(self, fields, filters=()):
+        if not self.projection_queries or fields is None or self.expanded_properties:
+            return None
+        projection = set(fields) - set(['key'])
+        if not projection or self.group_property in projection:
+            return None
+        projection.update(order.split()[0] for order in self.get_order_by(filters))
+        if any(prop_name in projection for prop_name, operator, value in filters if operator == '='):
+            return None
+        properties = self.model.properties()
+        for prop_name in projection:
+            prop = properties[prop_name]
+            if not prop.indexed or not isinstance(prop, self.projection_property_types):
+                return None
+        return sorted(projection)
+
+    def get_query_string(self, projection=None, filters=()):
+        conditions = []
         if self.group_property:
-            group_model_instance = self.model.properties()[self.group_property].reference_class.get(parent_key)
-            query_str = 'WHERE %s = :1 ' % self.group_property + query_str
-            model_instances = [model_instance for model_instance in
-                               self.model.gql(query_str, group_model_instance)]
+            conditions.append('%s = :1' % self.group_property)
         elif self.parent_model:
-            parent_model_instance = self.parent_model.get(parent_key)
-            query_str = 'WHERE ANCESTOR IS :1 ' + query_str
-            model_instances = [model_instance for model_instance in
-                               self.model.gql(query_str, parent_model_instance)]
+            conditions.append('ANCESTOR IS :1')
+        for prop_name, operator, value in filters:
+            conditions.append('%s %s :%d' % (prop_name, operator, len(conditions) + 1))
+
+        order_by = self.get_order_by(filters)
+        query_str = '' if not order_by else 'ORDER BY ' + ', '.join(order_by)
+        if conditions:
+            query_str = 'WHERE %s ' % ' AND '.join(conditions) + query_str
+        select = ', '.join(projection) if projection else '*'
+        return 'SELECT %s FROM %s %s' % (select, self.model.kind(), query_str)
+
+    def get_query_template(self, projection=None, filters=()):
+        query_plans = self.__class__.__dict__.get('_query_plans')
+        if query_plans is None:
+            query_plans = {}
+            setattr(self.__class__, '_query_plans', query_plans)
+        plan_key = (tuple(self.order_by), tuple(projection or ()),
+                    tuple((prop_name, operator) for prop_name, operator, value in filters))
+        query = query_plans.get(plan_key)
+        if query is None:
+            query = db.GqlQuery(self.get_query_string(projection, filters))
+            if len(query_plans) < self.max_query_plans:
+                query_plans[plan_key] = query
+        return query
+
+    def get_query(self, parent_key=None, projection=None, filters=()):
+        args = [parent_key] if self.get_parent_model() else []
+        args.extend(value for prop_name, operator, value in filters)
+
+        # GQL parsing is done once per plan; each request binds its arguments to a shallow copy.
+        query = copy.copy(self.get_query_template(projection, filters))
+        query.bind(*args)
+        return query
+
+    def run_queries(self, parent_key, projection=None, filters=(), limit=None, cursor=None):
+        """Run the collection query under each scope key, returning the results and a function for the cursor
+        after them.
+
+        Shards are merged by order_by (keys-only queries are simply chained) and paged with a comma-separated
+        cursor per shard, taken from that shard's own query after the last result the page used from it. Each
+        shard is fetched in batches of about its share of the page, so a page reads little more than ``limit``
+        entities unless the shards are uneven.
+        """
+        scope_keys = self.get_scope_keys(parent_key)
+        cursors = cursor.split(',') if cursor else [''] * len(scope_keys)
+        if len(cursors) != len(scope_keys):
+            raise Http4xx(400, 'Invalid cursor')
+        queries = []
+        for scope_key, shard_cursor in zip(scope_keys, cursors):
+            query = self.get_query(scope_key, projection, filters)
+            if shard_cursor:
+                try:
+                    query.with_cursor(shard_cursor)
+                except (db.BadValueError, db.BadRequestError):
+                    raise Http4xx(400, 'Invalid cursor')
+            queries.append(query)
+        if len(queries) == 1:
+            query = queries[0]
+            return (query.run(limit=limit, batch_size=limit) if limit else query.run(batch_size=self.batch_size),
+                    query.cursor)
+
+        batch_size = limit // len(queries) + 1 if limit else self.batch_size
+        pulled = [0] * len(queries)
+        used = [0] * len(queries)
+        used_cursors = list(cursors)
+
+        def run_shard(index, query):
+            for result in query.run(limit=limit, batch_size=batch_size):
+                pulled[index] += 1
+                yield result
+                # Only resumed once the merge has used ``result``, so this is the cursor just after it.
+                used_cursors[index] = query.cursor()
+
+        runs = [run_shard(index, query) for index, query in enumerate(queries)]
+        if projection == ['__key__']:
+            results = merge_sorted(runs, lambda key: None, used)
         else:
-            model_instances = [model_instance for model_instance in self.model.gql(query_str)]
+            results = merge_sorted(runs, get_sort_key(self.get_order_by(filters)), used)
+        if limit:
+            results = itertools.islice(results, limit)
 
-        if self.expanded_properties:
-            model_instances = [flatten_to_dict(model_instance, self.expanded_properties) for model_instance in model_instances]
+        def get_cursor():
+            # A shard whose every fetched result was used is still positioned just after the last one.
+            return ','.join(query.cursor() if pulled[index] and pulled[index] == used[index] else used_cursors[index]
+                            for index, query in enumerate(queries))
+        return results, get_cursor
+
+    def get_limit(self):
+        limit = self.request.get('limit')
+        if not limit:
+            return self.page_size
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise Http4xx(400, 'Invalid limit')
+        if limit < 1:
+            raise Http4xx(400, 'Invalid limit')
+        return min(limit, self.max_page_size)
+
+    def get_next_url(self, cursor, limit):
+        params = [(k.encode('utf-8'), v.encode('utf-8')) for k, v in self.request.GET.items()
+                  if k not in ('limit', 'cursor')]
+        params += [('limit', limit), ('cursor', cursor)]
+        return '%s?%s' % (self.request.path_url, urllib.urlencode(params))
+
+    def get_aggregates(self):
+        aggregates = []
+        for param in self.request.get('aggregate').split(','):
+            if not param:
+                continue
+            prop_name, _, function_name = param.partition('__')
+            if function_name not in self.aggregate_fields.get(prop_name, ()) or \
+                    function_name not in self.aggregate_functions:
+                raise Http4xx(400, 'Invalid aggregate: %s' % param)
+            aggregates.append((prop_name, function_name))
+        return aggregates
+
+    def get_aggregate_values(self, parent_key, filters, prop_name, function_names):
+        """Fold each function over the non-None values of ``prop_name``, a batch at a time.
+
+        A projection query is used where the property allows it, so full entities are only fetched as a fallback.
+        Every function is None when there are no values.
+        """
+        model_instances, _ = self.run_queries(parent_key, self.get_projection([prop_name], filters), filters)
+        values = (getattr(model_instance, prop_name) for model_instance in model_instances)
+        results = dict.fromkeys(function_names)
+        for batch in iter_batches((value for value in values if value is not None), self.batch_size):
+            for function_name in function_names:
+                function = self.aggregate_functions[function_name]
+                result = function(batch)
+                results[function_name] = result if results[function_name] is None else \
+                    function([results[function_name], result])
+        return results
+
+    def do_count(self, parent_key=None, **kwargs):
+        filters = self.get_filters()
+        aggregates = self.get_aggregates()
+
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        # Counts run keys-only on the datastore side, so no entity is materialized here.
+        count = sum(self.get_query(scope_key, None, filters).count(limit=self.max_count)
+                    for scope_key in self.get_scope_keys(parent_key))
+        totals = {'count': count if self.max_count is None else min(count, self.max_count)}
+        self.check_parent(parent_rpc)
+
+        function_names_by_prop = collections.OrderedDict()
+        for prop_name, function_name in aggregates:
+            function_names_by_prop.setdefault(prop_name, []).append(function_name)
+        for prop_name, function_names in function_names_by_prop.items():
+            results = self.get_aggregate_values(parent_key, filters, prop_name, function_names)
+            for function_name, result in results.items():
+                totals['%s__%s' % (prop_name, function_name)] = result
+        return totals
+
+    def do_head(self, parent_key=None, **kwargs):
+        totals = self.do_count(parent_key)
+        self.response.headers['X-Total-Count'] = str(totals['count'])
+        return totals
+
+    def do_get(self, parent_key=None, **kwargs):
+        if self.request.get('count') == 'true' or self.request.get('aggregate'):
+            return self.do_count(parent_key)
+
+        fields = self.get_fields()
+        filters = self.get_filters()
+        limit = self.get_limit()
+        cursor = self.request.get('cursor')
+        if cursor and not limit:
+            limit = self.max_page_size
+
+        # The parent lookup and the first query batch are in flight together; only block once both are issued.
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        model_instances, get_cursor = self.run_queries(parent_key, self.get_projection(fields, filters), filters,
+                                                       limit, cursor)
+        self.check_parent(parent_rpc)
+
+        if limit:
+            model_instances = list(model_instances)
+            if len(model_instances) == limit:
+                self.response.headers['Link'] = '<%s>; rel="next"' % self.get_next_url(get_cursor(), limit)
+
+        if self.embedded_properties:
+            model_instances = (resolve_snapshots([model_instance], self.embedded_properties)[0]
+                               for model_instance in model_instances)
+        if self.get_fetched_properties():
+            model_instances = iter_prefetched(model_instances, self.get_fetched_properties(), self.batch_size)
+        if self.expanded_properties or fields is not None:
+            model_instances = (self.represent(model_instance, fields) for model_instance in model_instances)
         return model_instances
 
 
 class CreateHandler(BaseHandler):
 
-    def do_post(self, parent_key=None, **kwargs):
-        content = clean(self.request.CONTENT, self.model)
-        if self.parent_model:
-            parent_model_instance = self.parent_model.get(parent_key)
-            content['parent'] = parent_model_instance
+    def get_scope(self, parent_key=None):
+        """Return the values every new entity in the collection is created with, and the parent lookup's RPC.
 
+        Under parent_model, 'parent' lists the ancestors an entity may be created under; build_model_instances
+        picks one per entity so that bulk writes are spread over every shard.
+        """
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        scope = {}
+        if self.parent_model:
+            scope['parent'] = self.get_scope_keys(parent_key)
         if self.group_property:
-            group_model_instance = self.model.properties()[self.group_property].reference_class.get(parent_key)
-            content[self.group_property] = group_model_instance
+            scope[self.group_property] = parent_key
+        if self.shard_property:
+            scope[self.shard_property] = parent_key
+        return scope, parent_rpc
 
-        if self.expanded_properties:
-            for prop_name in self.expanded_properties:
-                expanded_model = getattr(self.model, prop_name).reference_class
-                expanded_content = clean(self.request.CONTENT, expanded_model)
-                expanded_model_instance = expanded_model(**expanded_content)
-                expanded_model_instance.put()
-                content[prop_name] = expanded_model_instance
+    def build_model_instances(self, content, scope, expanded_keys):
+        cleaned_content = clean(content, self.model)
+        cleaned_content.update(scope)
+        if 'parent' in scope:
+            cleaned_content['parent'] = random.choice(scope['parent'])
 
-        model_instance = self.model(**content)
-        model_instance.put()
-        if self.expanded_properties:
-            return flatten_to_dict(model_instance, self.expanded_properties)
-        else:
-            return model_instance
+        model_instances = []
+        for prop_name, expanded_model in zip(self.expanded_properties, self.get_expanded_models()):
+            expanded_content = clean(content, expanded_model)
+            expanded_content.pop('key', None)
+            expanded_model_instance = expanded_model(key=next(expanded_keys), **expanded_content)
+            model_instances.append(expanded_model_instance)
+            cleaned_content[prop_name] = expanded_model_instance
+
+        model_instance = self.model(**cleaned_content)
+        self.embed_snapshots(model_instance)
+        model_instances.append(model_instance)
+        return model_instances
+
+    def do_post(self, parent_key=None, **kwargs):
+        # Validation and ID allocation overlap the parent lookup, which must succeed before anything is written.
+        scope, parent_rpc = self.get_scope(parent_key)
+        expanded_keys = iter(allocate_keys(self.get_expanded_models()))
+        model_instances = self.build_model_instances(self.request.CONTENT, scope, expanded_keys)
+        self.check_parent(parent_rpc)
+        self.put_model_instances(model_instances)
+        return self.represent(model_instances[-1])
 
 
 class ListOrCreateHandler(ListHandler, CreateHandler):
-    pass
+    bulk_batch_size = 500
+    max_transaction_groups = 25
+    bulk_errors = (db.BadValueError, db.BadKeyError, ValueError)
+    allow_clear = False
+    clear_limit = 1000
+
+    def delete(self, *args, **kwargs):
+        if self.request.content_length or 'Transfer-Encoding' in self.request.headers:
+            self._method(self.do_delete, None, parse, *args, **kwargs)
+        else:
+            self._method(self.do_clear, *args, **kwargs)
+
+    def check_deferred(self, method_name):
+        super(ListOrCreateHandler, self).check_deferred(method_name)
+        if method_name in ('do_bulk_post', 'do_put', 'do_delete'):
+            self.get_bulk_content()
+        elif method_name == 'do_clear':
+            self.check_clear()
+
+    def check_clear(self):
+        if not self.allow_clear:
+            raise Http4xx(405, 'Error 405 Method Not Allowed')
+        self.get_filters()
+        self.get_limit()
+
+    def get_bulk_write_size(self):
+        """Items per bulk write; when transactional, few enough that each batch stays within the entity groups one
+        cross-group transaction may write to.
+        """
+        if not self.transactional:
+            return self.bulk_batch_size
+        # Children of parent_model share its groups (a batch may use every shard); every other entity is a group of
+        # its own.
+        item_groups = len(self.expanded_properties) + (0 if self.parent_model else 1)
+        shared_groups = (self.shard_count or 1) if self.parent_model else 0
+        return max(1, min(self.bulk_batch_size, (self.max_transaction_groups - shared_groups) // max(item_groups, 1)))
+
+    def get_bulk_content(self):
+        content = self.request.CONTENT
+        if not isinstance(content, (list, JsonArrayIterator)):
+            raise Http4xx(400, 'Expected a list')
+        return content
+
+    def in_scope(self, model_instance, parent_key):
+        """Whether ``model_instance`` belongs to the collection under ``parent_key``.
+        """
+        if self.group_property:
+            return self.model.properties()[self.group_property].get_value_for_datastore(model_instance) == parent_key
+        if self.parent_model:
+            return model_instance.key().parent() in self.get_scope_keys(parent_key)
+        return True
+
+    def iter_bulk_batches(self, batch_size, statuses):
+        """Yield the bulk content in batches of ``batch_size``.
+
+        A streamed body is decoded as the batches are written, so one that turns out to be invalid or too large part
+        way through ends the batches with its error appended to ``statuses``: every item before that entry has its
+        status, and none after it was written.
+        """
+        batches = iter_batches(self.get_bulk_content(), batch_size)
+        while True:
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            except Http4xx as e:
+                statuses.append({'status': e.status_code, 'error': e.message})
+                return
+            yield batch
+
+    def get_bulk_model_instances(self, keys, parent_key=None):
+        valid_keys = []
+        statuses = []
+        for key in keys:
+            try:
+                if not isinstance(key, basestring):
+                    raise db.BadKeyError
+                key = db.Key(key)
+            except (db.BadKeyError, db.BadArgumentError):
+                statuses.append({'status': 400, 'error': 'Invalid key'})
+                valid_keys.append(None)
+            else:
+                statuses.append(None)
+                valid_keys.append(key if key.kind() == self.model.kind() else None)
+
+        fetched = iter(db.get([key for key in valid_keys if key is not None]))
+        model_instances = []
+        for index, key in enumerate(valid_keys):
+            model_instance = next(fetched) if key is not None else None
+            if model_instance is not None and not self.in_scope(model_instance, parent_key):
+                model_instance = None
+            if model_instance is None and statuses[index] is None:
+                statuses[index] = {'status': 404, 'key': keys[index], 'error': 'Not Found'}
+            model_instances.append(model_instance)
+        return model_instances, statuses
+
+    def do_post(self, parent_key=None, **kwargs):
+        if not isinstance(self.request.CONTENT, (list, JsonArrayIterator)):
+            return super(ListOrCreateHandler, self).do_post(parent_key, **kwargs)
+        return self.call(self.do_bulk_post, parent_key, **kwargs)
+
+    def do_bulk_post(self, parent_key=None, **kwargs):
+        scope, parent_rpc = self.get_scope(parent_key)
+        self.check_parent(parent_rpc)
+        expanded_models = self.get_expanded_models()
+        statuses = []
+        for contents in self.iter_bulk_batches(self.get_bulk_write_size(), statuses):
+            expanded_keys = iter(allocate_keys(expanded_models * len(contents)))
+            created = []
+            for content in contents:
+                try:
+                    if not isinstance(content, dict):
+                        raise ValueError('Expected an object')
+                    model_instances = self.build_model_instances(content, scope, expanded_keys)
+                except self.bulk_errors as e:
+                    statuses.append({'status': 400, 'error': unicode(e)})
+                else:
+                    statuses.append(None)
+                    created.append((len(statuses) - 1, model_instances))
+
+            self.put_model_instances([model_instance for index, model_instances in created
+                                      for model_instance in model_instances])
+            for index, model_instances in created:
+                statuses[index] = {'status': 201, 'key': unicode(model_instances[-1].key())}
+
+        self.response.set_status(207)
+        return statuses
+
+    def do_put(self, parent_key=None, **kwargs):
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        self.check_parent(parent_rpc)
+        statuses = []
+        for contents in self.iter_bulk_batches(self.get_bulk_write_size(), statuses):
+            keys = [content.get('key') if isinstance(content, dict) else None for content in contents]
+            model_instances, batch_statuses = self.get_bulk_model_instances(keys, parent_key)
+            if self.expanded_properties:
+                prefetch_references([model_instance for model_instance in model_instances if model_instance],
+                                    self.expanded_properties)
+
+            updated = []
+            stale = []
+            for index, (content, model_instance) in enumerate(zip(contents, model_instances)):
+                if model_instance is None:
+                    continue
+                try:
+                    updated_instances, stale_instances = self.update_model_instances(model_instance, content)
+                except self.bulk_errors as e:
+                    batch_statuses[index] = {'status': 400, 'key': keys[index], 'error': unicode(e)}
+                else:
+                    updated.append((index, updated_instances))
+                    stale.extend(stale_instances)
+
+            self.put_model_instances([model_instance for index, model_instances in updated
+                                      for model_instance in model_instances], stale)
+            for index, model_instances in updated:
+                batch_statuses[index] = {'status': 200, 'key': keys[index]}
+            statuses.extend(batch_statuses)
+
+        self.response.set_status(207)
+        return statuses
+
+    def do_delete(self, parent_key=None, **kwargs):
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        self.check_parent(parent_rpc)
+        statuses = []
+        for keys in self.iter_bulk_batches(self.bulk_batch_size, statuses):
+            model_instances, batch_statuses = self.get_bulk_model_instances(keys, parent_key)
+
+            delete_keys = []
+            for index, model_instance in enumerate(model_instances):
+                if model_instance is None:
+                    continue
+                delete_keys.append(model_instance.key())
+                delete_keys.extend(self.get_reference_keys(model_instance))
+                batch_statuses[index] = {'status': 204, 'key': keys[index]}
+
+            db.delete(delete_keys)
+            defer_sync(delete_keys, model_instances)
+            statuses.extend(batch_statuses)
+
+        self.response.set_status(207)
+        return statuses
+
+    def do_clear(self, parent_key=None, **kwargs):
+        """Delete up to a page of the scoped, filtered collection, linking to the rest like do_get does.
+
+        The collection is walked keys-only unless expanded references have to be read off the entities. Clearing
+        is refused with 405 unless allow_clear is set.
+        """
+        self.check_clear()
+        filters = self.get_filters()
+        limit = self.get_limit() or self.clear_limit
+        cursor = self.request.get('cursor')
+
+        parent_key, parent_rpc = self.get_parent_async(parent_key)
+        results, get_cursor = self.run_queries(parent_key, None if self.expanded_properties else ['__key__'], filters,
+                                               limit, cursor)
+        self.check_parent(parent_rpc)
+
+        deleted = 0
+        for batch in iter_batches(results, self.bulk_batch_size):
+            delete_keys = batch
+            if self.expanded_properties:
+                delete_keys = [model_instance.key() for model_instance in batch]
+                for model_instance in batch:
+                    delete_keys.extend(self.get_reference_keys(model_instance))
+            db.delete(delete_keys)
+            defer_sync(delete_keys, batch)
+            deleted += len(batch)
+
+        if deleted == limit:
+            self.response.headers['Link'] = '<%s>; rel="next"' % self.get_next_url(get_cursor(), limit)
+        return {'deleted': deleted}
 
 
 class GetHandler(BaseHandler):
 
     def do_get(self, key, **kwargs):
         model_instance = self.model.get(key)
-        if self.expanded_properties:
-            return flatten_to_dict(model_instance, self.expanded_properties)
-        else:
-            return model_instance
+        if model_instance is not None and self.embedded_properties:
+            resolve_snapshots([model_instance], self.embedded_properties)
+        return self.represent(model_instance, self.get_fields())
 
 
 class PutHandler(BaseHandler):
 
     def do_put(self, key, **kwargs):
+        return self.represent(self.run_in_transaction(self.put_model_instance, key, self.request.CONTENT))
+
+    def put_model_instance(self, key, content):
         model_instance = self.model.get(key)
-        content = clean(self.request.CONTENT, self.model)
+        self.check_if_match(model_instance)
+        self.put_model_instances(*self.update_model_instances(model_instance, content))
+        return model_instance
 
-        if self.expanded_properties:
-            for prop_name in self.expanded_properties:
-                prop = getattr(model_instance, prop_name)
-                expanded_model = getattr(self.model, prop_name).reference_class
-                expanded_content = clean(self.request.CONTENT, expanded_model)
-                for k, v in expanded_content.items():
-                    # TODO: Move 'key' check somewhere else
-                    if k != 'key':
-                        setattr(prop, k, v)
-                prop.put()
-                content[prop_name] = prop
 
-        for k, v in content.items():
-            # TODO: Move 'key' check somewhere else
-            if k != 'key':
-                setattr(model_instance, k, v)
-        model_instance.put()
+class PatchHandler(BaseHandler):
+
+    def check_deferred(self, method_name):
+        super(PatchHandler, self).check_deferred(method_name)
+        if method_name == 'do_patch':
+            self.get_patch_content()
+
+    def get_patch_content(self):
+        content = self.request.CONTENT
+        if not isinstance(content, dict):
+            raise Http4xx(400, 'Expected an object')
+        return content
+
+    def do_patch(self, key, **kwargs):
+        content = self.get_patch_content()
+        key = db.Key(key)
+        if key.kind() != self.model.kind():
+            raise Http4xx(404, 'Error 404 Not Found')
+        return self.represent(self.run_in_transaction(self.patch_model_instances, key, content))
+
+    def patch_model_instances(self, key, content):
+        model_instance = self.model.get(key)
+        if model_instance is None:
+            raise Http4xx(404, 'Error 404 Not Found')
+        self.check_if_match(model_instance)
+
+        # Children first and the parent last, as in update_model_instances; unchanged entities are not written.
+        changed = []
         if self.expanded_properties:
-            return flatten_to_dict(model_instance, self.expanded_properties)
-        else:
-            return model_instance
+            prefetch_references([model_instance], self.expanded_properties)
+            for prop_name in self.expanded_properties:
+                expanded_model_instance = getattr(model_instance, prop_name)
+                if self.patch_model_instance(expanded_model_instance, content):
+                    changed.append(expanded_model_instance)
+        if self.patch_model_instance(model_instance, content, self.expanded_properties) or \
+                (changed and self.embedded_properties):
+            self.embed_snapshots(model_instance)
+            changed.append(model_instance)
+        if changed:
+            self.put_model_instances(changed, changed)
+        return model_instance
 
 
 class DeleteHandler(BaseHandler):
 
     def do_delete(self, key, **kwargs):
+        """Delete the entity at ``key`` and its expanded references.
+
+        Without expanded properties or an If-Match precondition the key is deleted without being read, so deleting
+        a missing entity answers 204 like any repeated DELETE. Otherwise a missing entity answers 404.
+        """
+        key = db.Key(key)
+        if key.kind() != self.model.kind():
+            raise Http4xx(404, 'Error 404 Not Found')
+        if not self.expanded_properties and 'If-Match' not in self.request.headers:
+            db.delete(key)
+            defer_sync([key])
+            return None
+        return self.run_in_transaction(self.delete_model_instance, key)
+
+    def delete_model_instance(self, key):
         model_instance = self.model.get(key)
-        if self.expanded_properties:
-            for prop_name in self.expanded_properties:
-                prop = getattr(model_instance, prop_name)
-                prop.delete()
-        model_instance.delete()
+        if model_instance is None:
+            raise Http4xx(404, 'Error 404 Not Found')
+        self.check_if_match(model_instance)
+        reference_keys = self.get_reference_keys(model_instance)
+        if self.defer_cascades and reference_keys:
+            db.delete(key)
+            defer_sync([key], [model_instance])
+            # The task invalidates the cache again once the references are gone.
+            return self.respond_deferred(tasks.start(tasks.delete, reference_keys, self.get_cache_namespaces()))
+        db.delete([key] + reference_keys)
+        # Snapshots of deleted entities are cleared, so reads stop serving them.
+        defer_sync([key] + reference_keys, [model_instance])
         return None
 
 
-class InstanceHandler(GetHandler, PutHandler, DeleteHandler):
-    pass
\ No newline at end of file
+class InstanceHandler(GetHandler, PutHandler, PatchHandler, DeleteHandler):
+    pass
+
+
+class TaskStatusHandler(GetHandler):
+    model = tasks.TaskStatus
+
+    def represent(self, model_instance, fields=None):
+        dictionary = to_dict(model_instance, fields=fields)
+        if 'result' in dictionary:
+            dictionary['result'] = appenginejson.loads(model_instance.result) if model_instance.result else None
+        return dictionary
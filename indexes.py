@@ -0,0 +1,90 @@
+"""Report the composite indexes needed by ListHandler queries, in index.yaml format.
+
+Usage: python -m appengineserene.indexes myapp.handlers [myapp.other_handlers ...]
+"""
+import inspect
+import sys
+
+from appengineserene.handlers import ListHandler
+
+
+def parse_order(order):
+    parts = order.split()
+    return parts[0], 'desc' if len(parts) > 1 and parts[1].upper() == 'DESC' else 'asc'
+
+def get_indexes(handler):
+    ancestor = bool(handler.parent_model) and not handler.group_property
+    equalities = [handler.group_property] if handler.group_property else []
+    exact_prop_names = []
+    inequality_prop_names = []
+    for prop_name, lookups in sorted(handler.filter_fields.items()):
+        if prop_name not in handler.model.properties():
+            raise ValueError('%s.filter_fields: %s has no property %s' %
+                             (handler.__name__, handler.model.kind(), prop_name))
+        if 'exact' in lookups:
+            exact_prop_names.append(prop_name)
+        if set(lookups) - set(['exact']):
+            inequality_prop_names.append(prop_name)
+
+    candidates = [(equalities, None)]
+    candidates.extend((equalities + [prop_name], None) for prop_name in exact_prop_names)
+    candidates.extend((equalities, prop_name) for prop_name in inequality_prop_names)
+    # Several exact filters with an inequality are merge joined over one (exact, inequality) index per exact filter.
+    candidates.extend((equalities + [exact_prop_name], inequality_prop_name)
+                      for exact_prop_name in exact_prop_names for inequality_prop_name in inequality_prop_names
+                      if exact_prop_name != inequality_prop_name)
+
+    indexes = []
+    for equality_prop_names, inequality_prop_name in candidates:
+        orders = [parse_order(order) for order in handler.order_by]
+        if inequality_prop_name:
+            inequality_orders = [order for order in orders if order[0] == inequality_prop_name]
+            orders = (inequality_orders[:1] or [(inequality_prop_name, 'asc')]) + \
+                [order for order in orders if order[0] != inequality_prop_name]
+        # Sort orders on equality filtered properties are dropped by the datastore.
+        orders = [order for order in orders if order[0] not in equality_prop_names]
+        if not orders:
+            # Equality filters alone are served by merge joins over the built-in indexes.
+            continue
+        properties = [(prop_name, 'asc') for prop_name in equality_prop_names] + orders
+        if len(properties) < 2 and not ancestor:
+            continue
+        index = (handler.model.kind(), ancestor, tuple(properties))
+        if index not in indexes:
+            indexes.append(index)
+    return indexes
+
+def index_yaml(handlers):
+    indexes = []
+    for handler in handlers:
+        for index in get_indexes(handler):
+            if index not in indexes:
+                indexes.append(index)
+
+    lines = ['indexes:']
+    for kind, ancestor, properties in indexes:
+        lines.append('')
+        lines.append('- kind: %s' % kind)
+        if ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        for prop_name, direction in properties:
+            lines.append('  - name: %s' % prop_name)
+            if direction == 'desc':
+                lines.append('    direction: desc')
+    return '\n'.join(lines) + '\n'
+
+def find_handlers(module):
+    return [value for name, value in sorted(vars(module).items())
+            if inspect.isclass(value) and issubclass(value, ListHandler) and value.model is not None]
+
+def main(module_names):
+    handlers = []
+    for module_name in module_names:
+        __import__(module_name)
+        handlers.extend(find_handlers(sys.modules[module_name]))
+    sys.stdout.write(index_yaml(handlers))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
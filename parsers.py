@@ -1,19 +1,33 @@
 import json
+import re
 from urlparse import parse_qsl
 from webob.multidict import MultiDict
 
-from appengineserene.errors import ContentTypeNotSupportedError
+from appengineserene.errors import ContentTypeNotSupportedError, Http4xx
+from appengineserene.utils import Registry
 
 
 parsers = {}
+decoder_registry = Registry()
+decoders = decoder_registry.items
 
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
 
-def parse(request):
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def parse(request, max_body_size=None):
     content_type = request.content_type
     parser = parsers.get(content_type)
     if not parser:
         raise ContentTypeNotSupportedError
-    parser.parse(request)
+    parser.parse(request, max_body_size)
 
 def register(parser):
     parsers[parser.content_type] = parser
@@ -21,29 +35,169 @@ def register(parser):
 def deregister(parser):
     del parsers[parser.parser.content_type]
 
+def register_decoder(name, loads, priority=0):
+    decoder_registry.register(name, loads, priority)
+
+def get_decoder(name=None):
+    return decoder_registry.get(name)
+
+def check_body_size(request, max_body_size):
+    if max_body_size is not None and request.content_length > max_body_size:
+        raise Http4xx(413, 'Request Entity Too Large')
+
+def read_body(request, max_body_size=None):
+    check_body_size(request, max_body_size)
+    if max_body_size is None:
+        return request.body
+    body = request.body_file.read(max_body_size + 1)
+    if len(body) > max_body_size:
+        raise Http4xx(413, 'Request Entity Too Large')
+    return body
+
+
+WHITESPACE = re.compile(r'\s*')
+
+
+class JsonArrayIterator(object):
+    """Lazily decodes the elements of a JSON array, reading ``fileobj`` a chunk at a time.
+    """
+    def __init__(self, fileobj, max_body_size=None, chunk_size=64 * 1024):
+        self.fileobj = fileobj
+        self.max_body_size = max_body_size
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+        self.started = False
+        self.done = False
+
+    def fill(self, size=None):
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.size += len(chunk)
+        if self.max_body_size is not None and self.size > self.max_body_size:
+            raise Http4xx(413, 'Request Entity Too Large')
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def read_remaining(self):
+        while self.fill(-1 if self.max_body_size is None else self.max_body_size - self.size + 1):
+            pass
+        return self.buffer[self.pos:]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done:
+            raise StopIteration
+        char = self.peek()
+        if not self.started:
+            if char != '[':
+                raise Http4xx(400, 'Invalid JSON')
+            self.started = True
+            self.pos += 1
+            char = self.peek()
+            if char == ']':
+                return self.finish()
+        elif char == ']':
+            return self.finish()
+        elif char == ',':
+            self.pos += 1
+        else:
+            raise Http4xx(400, 'Invalid JSON')
+
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise Http4xx(400, 'Invalid JSON')
+                continue
+            # A value not followed by a delimiter (e.g. the "1." of "1.5") may continue in the next chunk.
+            after = WHITESPACE.match(self.buffer, end).end()
+            if (after == len(self.buffer) or self.buffer[after] not in ',]') and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def finish(self):
+        self.pos += 1
+        self.done = True
+        if self.peek():
+            raise Http4xx(400, 'Invalid JSON')
+        raise StopIteration
+
 
 class Parser:
 
     @classmethod
-    def parse(cls, request):
+    def parse(cls, request, max_body_size=None):
         raise NotImplementedError
 
 
 class JsonParser(Parser):
     content_type = 'application/json'
+    decoder = None
+    stream_threshold = 1024 * 1024
 
     @classmethod
-    def parse(cls, request):
-        request.CONTENT = json.loads(request.body)
+    def parse(cls, request, max_body_size=None):
+        check_body_size(request, max_body_size)
+        if cls.stream_threshold is not None and request.content_length > cls.stream_threshold:
+            content = JsonArrayIterator(request.body_file, max_body_size)
+            if content.peek() == '[':
+                request.CONTENT = content
+                return
+            body = content.read_remaining()
+        else:
+            body = read_body(request, max_body_size)
+        try:
+            request.CONTENT = get_decoder(cls.decoder)(body)
+        except ValueError:
+            raise Http4xx(400, 'Invalid JSON')
 
 
 class FormURLEncodedParser(Parser):
     content_type = 'application/x-www-form-urlencoded'
 
     @classmethod
-    def parse(cls, request):
-        request.CONTENT = MultiDict(parse_qsl(request.body))
+    def parse(cls, request, max_body_size=None):
+        request.CONTENT = MultiDict(parse_qsl(read_body(request, max_body_size)))
+
+
+class MsgPackParser(Parser):
+    content_type = 'application/x-msgpack'
+
+    @classmethod
+    def parse(cls, request, max_body_size=None):
+        try:
+            request.CONTENT = msgpack.unpackb(read_body(request, max_body_size), raw=False)
+        except (ValueError, msgpack.UnpackException):
+            raise Http4xx(400, 'Invalid MessagePack')
+
 
+register_decoder('json', json.loads)
+if simplejson is not None:
+    register_decoder('simplejson', simplejson.loads, priority=1)
 
 register(JsonParser)
-register(FormURLEncodedParser)
\ No newline at end of file
+register(FormURLEncodedParser)
+if msgpack is not None:
+    register(MsgPackParser)
@@ -0,0 +1,117 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import apiproxy_stub_map
+
+
+HOOK_NAME = 'appengineserene_profiling'
+
+local = threading.local()
+
+
+def count_rpc(service, call, request, response):
+    profile = getattr(local, 'profile', None)
+    if profile is not None:
+        profile.rpcs[service] = profile.rpcs.get(service, 0) + 1
+
+def start():
+    # The testbed swaps the apiproxy between tests, so make sure the hook is on the current one.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(HOOK_NAME, count_rpc)
+    local.profile = Profile()
+    return local.profile
+
+def stop():
+    profile = getattr(local, 'profile', None)
+    local.profile = None
+    return profile
+
+def server_timing_hook(handler, profile):
+    handler.response.headers['Server-Timing'] = profile.server_timing()
+
+def log_hook(handler, profile):
+    logging.info('profile %s', json.dumps(dict(profile.as_dict(), method=handler.request.method,
+                                               path=handler.request.path, status=handler.response.status_int)))
+
+
+class Phase(object):
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add(self.name, time.time() - self.started)
+
+
+class Profile(object):
+    """Per-request phase timings (in seconds) and RPC counts per API service.
+    """
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.rpcs = {}
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def iter_timed(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.time() - started)
+                return
+            self.add(name, time.time() - started)
+            yield item
+
+    def as_dict(self):
+        return {
+            'timings': OrderedDict((name, round(seconds * 1000, 3)) for name, seconds in self.timings.items()),
+            'rpcs': dict(self.rpcs),
+        }
+
+    def server_timing(self):
+        metrics = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in self.timings.items()]
+        metrics.extend('%s;desc="%d RPCs"' % (service, count) for service, count in sorted(self.rpcs.items()))
+        return ', '.join(metrics)
+
+
+class NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullProfile(object):
+    """Stands in for Profile when profiling is off, so instrumented code needs no checks.
+    """
+    timings = {}
+    rpcs = {}
+    null_phase = NullPhase()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def add(self, name, seconds):
+        pass
+
+    def iter_timed(self, name, iterable):
+        return iterable
+
+
+NULL_PROFILE = NullProfile()
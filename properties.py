@@ -0,0 +1,121 @@
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db, deferred
+
+from appengineserene import cache
+
+
+snapshots = {}
+
+
+class SnapshotProperty(db.UnindexedProperty):
+    """Denormalized copy of the entity behind ``reference_name``, stored as an encoded entity blob.
+
+    The value is a model instance (with its key), so a handler can resolve the reference from the snapshot
+    instead of getting it from the datastore. sync_snapshots refreshes the copies when the referenced entity
+    is written or deleted elsewhere.
+    """
+    data_type = db.Model
+
+    def __init__(self, reference_name, **kwargs):
+        super(SnapshotProperty, self).__init__(**kwargs)
+        self.reference_name = reference_name
+
+    def __property_config__(self, model_class, property_name):
+        super(SnapshotProperty, self).__property_config__(model_class, property_name)
+        # Properties are configured one by one while the class is built, so read the reference off the class.
+        reference_class = getattr(model_class, self.reference_name).reference_class
+        snapshots.setdefault(reference_class.kind(), []).append((model_class, self.reference_name, property_name))
+
+    def validate(self, value):
+        if value is not None and not isinstance(value, db.Model):
+            raise db.BadValueError('Property %s must be a model instance' % self.name)
+        return super(SnapshotProperty, self).validate(value)
+
+    def empty(self, value):
+        return value is None
+
+    def get_value_for_datastore(self, model_instance):
+        value = super(SnapshotProperty, self).get_value_for_datastore(model_instance)
+        if value is None:
+            return None
+        return db.Blob(db.model_to_protobuf(value).Encode())
+
+    def make_value_from_datastore(self, value):
+        if value is None:
+            return None
+        return db.model_from_protobuf(entity_pb.EntityProto(value))
+
+
+def get_snapshot_name(model_class, reference_name):
+    for prop_name, prop in model_class.properties().items():
+        if isinstance(prop, SnapshotProperty) and prop.reference_name == reference_name:
+            return prop_name
+    raise ValueError('%s has no snapshot of %s' % (model_class.kind(), reference_name))
+
+def resolve_snapshots(model_instances, reference_names):
+    """Point each reference at its snapshot, so reading it costs no datastore get.
+
+    References without a current snapshot are left alone and are fetched as usual when read.
+    """
+    for model_instance in model_instances:
+        properties = model_instance.properties()
+        for reference_name in reference_names:
+            prop = properties[reference_name]
+            snapshot = getattr(model_instance, get_snapshot_name(model_instance.__class__, reference_name))
+            if snapshot is not None and snapshot.key() == prop.get_value_for_datastore(model_instance):
+                prop.__set__(model_instance, snapshot)
+    return model_instances
+
+def get_snapshot_state(model_instance):
+    """The stored values a snapshot of ``model_instance`` copies, or None if no model keeps snapshots of its kind.
+
+    auto_now timestamps are left out, since every put changes them.
+    """
+    if model_instance.kind() not in snapshots:
+        return None
+    return dict((prop_name, prop.get_value_for_datastore(model_instance))
+                for prop_name, prop in model_instance.properties().items() if not getattr(prop, 'auto_now', False))
+
+@db.non_transactional
+def has_referrers(key, written=()):
+    """Whether any entity keeps a snapshot of the one at ``key``, apart from those among ``written`` that were put
+    (or deleted) along with it.
+    """
+    for model_class, reference_name, snapshot_name in snapshots.get(key.kind(), ()):
+        prop = model_class.properties()[reference_name]
+        fresh_keys = set(model_instance.key() for model_instance in written if isinstance(model_instance, model_class)
+                         and prop.get_value_for_datastore(model_instance) == key)
+        query = model_class.all(keys_only=True).filter('%s =' % reference_name, key)
+        if any(referrer_key not in fresh_keys for referrer_key in query.fetch(len(fresh_keys) + 1)):
+            return True
+    return False
+
+def defer_sync(keys, written=()):
+    """Queue a snapshot refresh for the entities at ``keys`` that have just changed or been deleted, if anything
+    besides ``written`` keeps snapshots of them. Inside a transaction, the task is only enqueued if it commits.
+    """
+    keys = [key for key in keys if key.kind() in snapshots and has_referrers(key, written)]
+    if keys:
+        deferred.defer(sync_snapshots, keys, _transactional=db.is_in_transaction())
+
+def sync_snapshots(keys, batch_size=100):
+    for key, referenced_instance in zip(keys, db.get(keys)):
+        for model_class, reference_name, snapshot_name in snapshots.get(key.kind(), ()):
+            prop = model_class.properties()[snapshot_name]
+            stale = []
+            synced = False
+            for model_instance in model_class.all().filter('%s =' % reference_name, key).run(batch_size=batch_size):
+                current = prop.get_value_for_datastore(model_instance)
+                setattr(model_instance, snapshot_name, referenced_instance)
+                if prop.get_value_for_datastore(model_instance) != current:
+                    stale.append(model_instance)
+                if len(stale) == batch_size:
+                    db.put(stale)
+                    stale = []
+                    synced = True
+            if stale:
+                db.put(stale)
+                synced = True
+            if synced:
+                # Cached responses embed the snapshots just replaced.
+                cache.invalidate(model_class.kind())
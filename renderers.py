@@ -0,0 +1,116 @@
+import collections
+
+from google.appengine.ext import db
+
+import appenginejson
+
+from appengineserene.utils import dumps_iter, to_dict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+renderers = {}
+
+
+def negotiate(request):
+    offers = [JsonRenderer.media_type] + sorted(media_type for media_type in renderers
+                                                if media_type != JsonRenderer.media_type)
+    media_type = request.accept.best_match(offers, default_match=JsonRenderer.media_type)
+    return renderers.get(media_type, JsonRenderer)
+
+def register(renderer):
+    renderers[renderer.media_type] = renderer
+
+def deregister(renderer):
+    del renderers[renderer.media_type]
+
+def to_primitive(value):
+    """Convert ``value`` to plain lists, dicts and scalars, matching its appenginejson representation.
+    """
+    if isinstance(value, (basestring, bool, int, long, float, type(None))):
+        return value
+    if isinstance(value, db.Model):
+        value = to_dict(value)
+    if isinstance(value, dict):
+        return dict((key, to_primitive(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple, collections.Iterator)):
+        return [to_primitive(item) for item in value]
+    return appenginejson.loads(appenginejson.dumps(value))
+
+
+class Renderer:
+
+    @classmethod
+    def accepts(cls, handler, result):
+        return True
+
+    @classmethod
+    def render(cls, handler, result):
+        raise NotImplementedError
+
+    @classmethod
+    def render_iter(cls, handler, results):
+        yield cls.render(handler, list(results))
+
+
+class JsonRenderer(Renderer):
+    media_type = 'application/json'
+
+    @classmethod
+    def render(cls, handler, result):
+        return handler.get_encoder().dumps(result)
+
+    @classmethod
+    def render_iter(cls, handler, results):
+        return dumps_iter(results, handler.get_encoder().dumps)
+
+
+class ColumnarJsonRenderer(Renderer):
+    """Renders a list as ``{"columns": [...], "rows": [[...], ...]}`` so property names are sent once.
+
+    Columns are taken from the first row, so only lists whose rows all share its keys are accepted: the entities a
+    GET lists, never the mixed statuses of a bulk write.
+    """
+    media_type = 'application/vnd.appengineserene.columns+json'
+
+    @classmethod
+    def accepts(cls, handler, result):
+        return handler.request.method == 'GET' and isinstance(result, (list, tuple, collections.Iterator))
+
+    @classmethod
+    def render(cls, handler, result):
+        return ''.join(cls.render_iter(handler, result))
+
+    @classmethod
+    def render_iter(cls, handler, results):
+        dumps = handler.get_encoder().dumps
+        columns = None
+        for item in results:
+            if isinstance(item, db.Model):
+                item = to_dict(item)
+            if columns is None:
+                columns = sorted(item)
+                yield '{"columns":%s,"rows":[' % dumps(columns)
+                yield dumps([item.get(column) for column in columns])
+            else:
+                yield ',' + dumps([item.get(column) for column in columns])
+        if columns is None:
+            yield '{"columns":[],"rows":['
+        yield ']}'
+
+
+class MsgPackRenderer(Renderer):
+    media_type = 'application/x-msgpack'
+
+    @classmethod
+    def render(cls, handler, result):
+        return msgpack.packb(to_primitive(result), use_bin_type=True)
+
+
+register(JsonRenderer)
+register(ColumnarJsonRenderer)
+if msgpack is not None:
+    register(MsgPackRenderer)
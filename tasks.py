@@ -0,0 +1,80 @@
+import logging
+
+import webapp2
+from google.appengine.ext import db, deferred
+
+import appenginejson
+
+from appengineserene import cache
+from appengineserene.errors import Http4xx
+from appengineserene.parsers import JsonArrayIterator
+from appengineserene.properties import defer_sync
+from appengineserene.renderers import to_primitive
+
+
+class TaskStatus(db.Model):
+    state = db.StringProperty(required=True, default='pending', choices=('pending', 'running', 'done', 'failed'))
+    result = db.TextProperty()
+    status_code = db.IntegerProperty()
+    error = db.TextProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+
+def start(function, *args, **kwargs):
+    """Put a pending TaskStatus and defer ``function`` to run against it; inside a transaction, the task is only
+    enqueued if the transaction commits.
+    """
+    status = TaskStatus()
+    status.put()
+    deferred.defer(run, status.key(), function, args, kwargs, _transactional=db.is_in_transaction())
+    return status
+
+def run(status_key, function, args, kwargs):
+    status = TaskStatus.get(status_key)
+    status.state = 'running'
+    status.put()
+    try:
+        result = function(*args, **kwargs)
+    except Http4xx as e:
+        status.state = 'failed'
+        status.status_code = e.status_code
+        status.error = unicode(e.message)
+    except Exception as e:
+        # Failures are recorded for the client to poll rather than retried, since the work may be partly done.
+        logging.exception('Task %s failed', status_key)
+        status.state = 'failed'
+        status.error = unicode(e)
+    else:
+        status.state = 'done'
+        status.result = appenginejson.dumps(to_primitive(result))
+    status.put()
+
+def delete(keys, cache_namespaces=()):
+    """Delete ``keys``, then clear their snapshots and invalidate the caches that may still hold them.
+    """
+    db.delete(keys)
+    defer_sync(keys)
+    for namespace in cache_namespaces:
+        cache.invalidate(namespace)
+
+def defer_handler_method(handler, method_name, args, kwargs):
+    content = getattr(handler.request, 'CONTENT', None)
+    if isinstance(content, JsonArrayIterator):
+        content = list(content)
+    # The body is replaced by its parsed content, so the headers describing it are not replayed.
+    headers = dict((name, value) for name, value in handler.request.headers.items()
+                   if name not in ('Content-Length', 'Transfer-Encoding'))
+    return start(run_handler_method, handler.__class__, method_name, handler.request.method, handler.request.path_qs,
+                 headers, content, args, kwargs)
+
+def run_handler_method(handler_class, method_name, method, path_qs, headers, content, args, kwargs):
+    """Replay a deferred do_* method on a handler built from the original request line, headers and parsed content.
+    """
+    request = webapp2.Request.blank(path_qs, environ={'REQUEST_METHOD': method})
+    request.headers.update(headers)
+    request.CONTENT = content
+    handler = handler_class(request, webapp2.Response())
+    result = getattr(handler, method_name)(*args, **kwargs)
+    handler.invalidate_cache()
+    return {'status': handler.response.status_int, 'body': result}
@@ -1,23 +1,65 @@
 from appengineserene.handlers import ListOrCreateHandler, InstanceHandler
-from appengineserene.tests.models import ProjectDummy, StoryDummy, ScrumStoryDummy
+from appengineserene.tests.models import (ProjectDummy, StoryDummy, ScrumStoryDummy, EmbeddedScrumStoryDummy,
+                                          ShardedStoryDummy)
 
 
 class ProjectListOrCreateHandler(ListOrCreateHandler):
     model = ProjectDummy
     order_by = ('number', 'name')
+    filter_fields = {
+        'number': ('exact', 'lt', 'lte', 'gt', 'gte'),
+        'name': ('exact',),
+    }
+    aggregate_fields = {
+        'number': ('sum', 'min', 'max'),
+    }
+    task_status_route = 'task-status'
+    allow_clear = True
+
+
+class ProjectInstanceHandler(InstanceHandler):
+    model = ProjectDummy
+    use_etags = True
 
 
 class StoryListOrCreateHandler(ListOrCreateHandler):
     model = StoryDummy
     order_by = ('number',)
     parent_model = ProjectDummy
+    allow_clear = True
+
+
+class ShardedStoryListOrCreateHandler(ListOrCreateHandler):
+    model = ShardedStoryDummy
+    order_by = ('number',)
+    parent_model = ProjectDummy
+    filter_fields = {
+        'number': ('gte',),
+    }
+    shard_count = 4
+    shard_property = 'project'
+    allow_clear = True
 
 
 class ScrumStoryListOrCreateHandler(ListOrCreateHandler):
     model = ScrumStoryDummy
     expanded_properties = ('story',)
+    allow_clear = True
 
 
 class ScrumStoryInstanceHandler(InstanceHandler):
     model = ScrumStoryDummy
-    expanded_properties = ('story',)
\ No newline at end of file
+    expanded_properties = ('story',)
+    task_status_route = 'task-status'
+
+
+class EmbeddedScrumStoryListOrCreateHandler(ListOrCreateHandler):
+    model = EmbeddedScrumStoryDummy
+    expanded_properties = ('story',)
+    embedded_properties = ('story',)
+
+
+class EmbeddedScrumStoryInstanceHandler(InstanceHandler):
+    model = EmbeddedScrumStoryDummy
+    expanded_properties = ('story',)
+    embedded_properties = ('story',)
\ No newline at end of file
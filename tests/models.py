@@ -1,11 +1,14 @@
 from google.appengine.ext import db
 
+from appengineserene.properties import SnapshotProperty
+
 
 class ProjectDummy(db.Model):
     number = db.IntegerProperty(required=True)
     name = db.StringProperty(required=True)
     description = db.TextProperty()
     owner = db.UserProperty(auto_current_user_add=True)
+    updated = db.DateTimeProperty(auto_now=True)
 
 
 class StoryDummy(db.Model):
@@ -15,4 +18,16 @@ class StoryDummy(db.Model):
 
 class ScrumStoryDummy(db.Model):
     story = db.ReferenceProperty(StoryDummy, required=True)
-    status = db.StringProperty()
\ No newline at end of file
+    status = db.StringProperty()
+
+
+class EmbeddedScrumStoryDummy(db.Model):
+    story = db.ReferenceProperty(StoryDummy, required=True)
+    story_snapshot = SnapshotProperty('story')
+    status = db.StringProperty()
+
+
+class ShardedStoryDummy(db.Model):
+    project = db.ReferenceProperty(ProjectDummy)
+    number = db.IntegerProperty()
+    title = db.StringProperty(required=True)
\ No newline at end of file
@@ -1,15 +1,33 @@
+import collections
+import json
+import random
+import threading
+import time
+import zlib
 from datetime import datetime
+from StringIO import StringIO
 
 import unittest2
+import webapp2
 import webtest
-from google.appengine.ext import testbed
+from google.appengine.ext import db, deferred, testbed
 
 import appenginejson
 from appenginetest.utils import setCurrentUser, logoutCurrentUser
 
-from appengineserene.tests.handlers import ProjectListOrCreateHandler
-from appengineserene.tests.models import ProjectDummy, StoryDummy, ScrumStoryDummy
+from appengineserene import cache, profiling
+from appengineserene.encoders import AppEngineJsonEncoder, ModelJsonEncoder, get_encoder
+from appengineserene.errors import Http4xx
+from appengineserene.indexes import get_indexes, index_yaml
+from appengineserene.parsers import JsonArrayIterator, JsonParser, get_decoder, simplejson
+from appengineserene.renderers import ColumnarJsonRenderer, MsgPackRenderer, msgpack
+from appengineserene.tests.handlers import (ProjectListOrCreateHandler, ProjectInstanceHandler,
+                                            ScrumStoryListOrCreateHandler, ScrumStoryInstanceHandler,
+                                            ShardedStoryListOrCreateHandler, StoryListOrCreateHandler)
+from appengineserene.tests.models import (ProjectDummy, StoryDummy, ScrumStoryDummy, EmbeddedScrumStoryDummy,
+                                          ShardedStoryDummy)
 from appengineserene.tests.urls import app
+from appengineserene.utils import allocate_keys, dumps_iter, get_schema, prefetch_references
 
 
 class BaseTestHandler(unittest2.TestCase):
@@ -19,7 +37,10 @@ class BaseTestHandler(unittest2.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
         self.testbed.init_user_stub()
+        cache.local_cache.clear()
         setCurrentUser('mouse@lemur.com', 'Microcebus')
 
         self.project_apple_kwargs = {
@@ -66,6 +87,15 @@ class BaseTestHandler(unittest2.TestCase):
         logoutCurrentUser()
         self.testbed.deactivate()
 
+    def run_tasks(self):
+        taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue_stub.get_filtered_tasks()
+        while tasks:
+            taskqueue_stub.FlushQueue('default')
+            for task in tasks:
+                deferred.run(task.payload)
+            tasks = taskqueue_stub.get_filtered_tasks()
+
     def assertEqualProjectAppleDict(self, project_dict):
         self.assertEqual(project_dict['number'], 1)
         self.assertEqual(project_dict['name'], 'Apple')
@@ -296,245 +326,2016 @@ class TestProjectListHandler__OrderBy(BaseTestHandler):
         self.assertEqualProjectDewberryDict(project_dicts[4])
 
 
-class TestStoryListHandler(BaseTestHandler):
+class TestProjectListHandler__Pagination(BaseTestHandler):
 
-    def test_list_stories(self):
+    def setUp(self):
+        super(TestProjectListHandler__Pagination, self).setUp()
+        self._page_size_orig = ProjectListOrCreateHandler.page_size
+        ProjectListOrCreateHandler.page_size = 2
+
+        self.project_dewberry = ProjectDummy(**self.project_dewberry_kwargs)
+        self.project_dewberry.put()
+        self.project_coconut = ProjectDummy(**self.project_coconut_kwargs)
+        self.project_coconut.put()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.project_banana = ProjectDummy(**self.project_banana_kwargs)
+        self.project_banana.put()
+        self.project_apple_too = ProjectDummy(**self.project_apple_too_kwargs)
+        self.project_apple_too.put()
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.page_size = self._page_size_orig
+        super(TestProjectListHandler__Pagination, self).tearDown()
+
+    def get_next_url(self, response):
+        link = response.headers.get('Link')
+        if not link:
+            return None
+        self.assertTrue(link.endswith('>; rel="next"'))
+        return link[1:link.index('>')]
+
+    def test_list_projects__page_size(self):
         """
-        Test that returned stories are order by number.
+        Test that projects are returned in pages of page_size, linked by cursors.
         """
-        project_apple = ProjectDummy(**self.project_apple_kwargs)
-        project_apple.put()
-        story_throw = StoryDummy(parent=project_apple, **self.story_throw_kwargs)
-        story_throw.put()
-        story_eat = StoryDummy(parent=project_apple, **self.story_eat_kwargs)
-        story_eat.put()
-        story_grow = StoryDummy(parent=project_apple, **self.story_grow_kwargs)
-        story_grow.put()
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.status_int, 200)
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(project_dicts), 2)
+        self.assertEqual(project_dicts[0]['key'], str(self.project_apple.key()))
+        self.assertEqual(project_dicts[1]['key'], str(self.project_coconut.key()))
 
-        response = self.testapp.get('/projects/%s/stories' % str(project_apple.key()))
+        response = self.testapp.get(self.get_next_url(response))
         self.assertEqual(response.status_int, 200)
-        self.assertEqual(response.content_type, 'application/json')
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(project_dicts), 2)
+        self.assertEqual(project_dicts[0]['key'], str(self.project_apple_too.key()))
+        self.assertEqual(project_dicts[1]['key'], str(self.project_banana.key()))
 
-        story_dicts = appenginejson.loads(response.normal_body)
-        self.assertEqual(len(story_dicts), 3)
+        response = self.testapp.get(self.get_next_url(response))
+        self.assertEqual(response.status_int, 200)
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(project_dicts), 1)
+        self.assertEqual(project_dicts[0]['key'], str(self.project_dewberry.key()))
+        self.assertEqual(self.get_next_url(response), None)
 
-        self.assertEqual(story_dicts[0]['key'], str(story_eat.key()))
-        self.assertEqualStoryEatDict(story_dicts[0])
-        self.assertEqual(story_dicts[1]['key'], str(story_grow.key()))
-        self.assertEqualStoryGrowDict(story_dicts[1])
-        self.assertEqual(story_dicts[2]['key'], str(story_throw.key()))
-        self.assertEqualStoryThrowDict(story_dicts[2])
+    def test_list_projects__limit(self):
+        """
+        Test that the limit query parameter overrides page_size.
+        """
+        response = self.testapp.get('/projects?limit=4')
+        self.assertEqual(response.status_int, 200)
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(project_dicts), 4)
+        self.assertTrue('limit=4' in self.get_next_url(response))
 
+        response = self.testapp.get(self.get_next_url(response))
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(project_dicts), 1)
+        self.assertEqual(project_dicts[0]['key'], str(self.project_dewberry.key()))
 
-class TestStoryCreateHandler(BaseTestHandler):
+    def test_list_projects__no_page_size(self):
+        """
+        Test that all projects are returned when neither page_size nor limit is given.
+        """
+        ProjectListOrCreateHandler.page_size = None
 
-    def test_create_story(self):
-        project_apple = ProjectDummy(**self.project_apple_kwargs)
-        project_apple.put()
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 5)
+        self.assertEqual(self.get_next_url(response), None)
 
-        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
-        self.assertEqual(response.status_int, 201)
-        self.assertEqual(response.content_type, 'application/json')
+    def test_list_projects__invalid_limit(self):
+        response = self.testapp.get('/projects?limit=abc', status=400)
+        self.assertEqual(response.status_int, 400)
 
-        story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqualStoryEatDict(story_dict)
+        response = self.testapp.get('/projects?limit=0', status=400)
+        self.assertEqual(response.status_int, 400)
 
-        story = StoryDummy.get(story_dict['key'])
-        self.assertEqualStoryEat(story)
+    def test_list_projects__invalid_cursor(self):
+        response = self.testapp.get('/projects?cursor=abc', status=400)
+        self.assertEqual(response.status_int, 400)
 
-    def test_create_story__blank_number(self):
-        project_apple = ProjectDummy(**self.project_apple_kwargs)
-        project_apple.put()
-        self.story_eat_kwargs['number'] = ''
 
-        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
-        self.assertEqual(response.status_int, 201)
-        self.assertEqual(response.content_type, 'application/json')
+class TestProjectListHandler__Streaming(BaseTestHandler):
 
-        story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqual(story_dict['number'], None)
-        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+    def test_list_projects__lazy_iterator(self):
+        """
+        Test that do_get returns a lazy iterator rather than a materialized list.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectDummy(**self.project_banana_kwargs).put()
 
-        story = StoryDummy.get(story_dict['key'])
-        self.assertEqual(story.number, None)
-        self.assertEqual(story.title, 'Eat an apple a day')
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        result = handler.do_get()
+        self.assertFalse(isinstance(result, list))
+        self.assertTrue(isinstance(result, collections.Iterator))
+        self.assertEqual(len(list(result)), 2)
 
-    def test_create_story__none_number(self):
+    def test_dumps_iter(self):
+        self.assertEqual(''.join(dumps_iter(iter([]))), '[]')
+        self.assertEqual(appenginejson.loads(''.join(dumps_iter(iter([1, 'a', {'b': 2}])))),
+                         [1, 'a', {'b': 2}])
+
+
+class TestProjectListOrCreateHandler__Bulk(BaseTestHandler):
+
+    def test_bulk_create_projects(self):
+        """
+        Test that a list body creates every valid project and reports a status per item.
+        """
+        invalid_kwargs = {'number': 3}
+
+        response = self.testapp.post_json('/projects', [self.project_apple_kwargs, invalid_kwargs,
+                                                        self.project_banana_kwargs])
+        self.assertEqual(response.status_int, 207)
+        self.assertEqual(response.content_type, 'application/json')
+
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [201, 400, 201])
+        self.assertEqual(ProjectDummy.get(statuses[0]['key']).name, 'Apple')
+        self.assertEqual(ProjectDummy.get(statuses[2]['key']).name, 'Banana')
+        self.assertEqual(ProjectDummy.all().count(), 2)
+
+    def test_bulk_update_projects(self):
         project_apple = ProjectDummy(**self.project_apple_kwargs)
         project_apple.put()
-        self.story_eat_kwargs['number'] = None
+        project_banana = ProjectDummy(**self.project_banana_kwargs)
+        project_banana.put()
 
-        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
-        self.assertEqual(response.status_int, 201)
-        self.assertEqual(response.content_type, 'application/json')
+        coconut_kwargs = dict(self.project_coconut_kwargs, key=str(project_apple.key()))
+        dewberry_kwargs = dict(self.project_dewberry_kwargs, key=str(project_banana.key()))
+        missing_kwargs = dict(self.project_dewberry_kwargs, key=str(db.Key.from_path('ProjectDummy', 12345)))
 
-        story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqual(story_dict['number'], None)
-        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+        response = self.testapp.put_json('/projects', [coconut_kwargs, missing_kwargs, dewberry_kwargs])
+        self.assertEqual(response.status_int, 207)
 
-        story = StoryDummy.get(story_dict['key'])
-        self.assertEqual(story.number, None)
-        self.assertEqual(story.title, 'Eat an apple a day')
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [200, 404, 200])
+        self.assertEqual(ProjectDummy.get(project_apple.key()).name, 'Coconut')
+        self.assertEqual(ProjectDummy.get(project_banana.key()).name, 'Dewberry')
+        self.assertEqual(ProjectDummy.all().count(), 2)
 
-    def test_create_story__missing_number(self):
+    def test_bulk_delete_projects(self):
         project_apple = ProjectDummy(**self.project_apple_kwargs)
         project_apple.put()
-        del self.story_eat_kwargs['number']
+        project_banana = ProjectDummy(**self.project_banana_kwargs)
+        project_banana.put()
+        project_coconut = ProjectDummy(**self.project_coconut_kwargs)
+        project_coconut.put()
 
-        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
-        self.assertEqual(response.status_int, 201)
-        self.assertEqual(response.content_type, 'application/json')
+        response = self.testapp.request('/projects', method='DELETE', content_type='application/json',
+                                        body=appenginejson.dumps([str(project_apple.key()), 'invalid',
+                                                                  str(project_coconut.key())]))
+        self.assertEqual(response.status_int, 207)
 
-        story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqual(story_dict['number'], None)
-        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [204, 400, 204])
+        self.assertEqual([project.name for project in ProjectDummy.all()], ['Banana'])
 
-        story = StoryDummy.get(story_dict['key'])
-        self.assertEqual(story.number, None)
-        self.assertEqual(story.title, 'Eat an apple a day')
+    def test_bulk_update_projects__not_a_list(self):
+        response = self.testapp.put_json('/projects', self.project_apple_kwargs, status=400)
+        self.assertEqual(response.status_int, 400)
 
 
-class BaseTestScrumStoryHandler(BaseTestHandler):
+class TestProjectListOrCreateHandler__Cache(BaseTestHandler):
 
     def setUp(self):
-        super(BaseTestScrumStoryHandler, self).setUp()
+        super(TestProjectListOrCreateHandler__Cache, self).setUp()
+        self._cache_ttl_orig = ProjectListOrCreateHandler.cache_ttl
+        ProjectListOrCreateHandler.cache_ttl = 60
 
-        self.scrum_story_eat_kwargs = {
-            'status': 'ToDo'
-        }
-        self.scrum_story_grow_kwargs = {
-            'status': 'Complete'
-        }
-        self.scrum_story_throw_kwargs = {
-            'status': 'InProgress'
-        }
+    def tearDown(self):
+        ProjectListOrCreateHandler.cache_ttl = self._cache_ttl_orig
+        super(TestProjectListOrCreateHandler__Cache, self).tearDown()
 
-    def assertEqualScrumStoryEatDict(self, scrum_story_dict):
-        self.assertEqual(scrum_story_dict['status'], 'ToDo')
+    def test_list_projects__cached(self):
+        """
+        Test that a cached list is served without touching the datastore until a write invalidates it.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
 
-    def assertEqualScrumStoryGrowDict(self, scrum_story_dict):
-        self.assertEqual(scrum_story_dict['status'], 'Complete')
+        response = self.testapp.get('/projects')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
 
-    def assertEqualScrumStoryThrowDict(self, scrum_story_dict):
-        self.assertEqual(scrum_story_dict['status'], 'InProgress')
+        # Written behind the handler's back, so the cached list is still served.
+        ProjectDummy(**self.project_banana_kwargs).put()
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
 
-    def assertEqualScrumStoryEat(self, scrum_story):
-        self.assertEqual(scrum_story.status, 'ToDo')
+        self.testapp.post_json('/projects', self.project_coconut_kwargs)
+        response = self.testapp.get('/projects')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 3)
 
-    def assertEqualScrumStoryGrow(self, scrum_story):
-        self.assertEqual(scrum_story.status, 'Complete')
+    def test_list_projects__cached_per_query_string(self):
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectDummy(**self.project_banana_kwargs).put()
 
+        response = self.testapp.get('/projects?limit=1')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
+        link = response.headers['Link']
 
-class TestScrumStoryListHandler(BaseTestScrumStoryHandler):
+        response = self.testapp.get('/projects?limit=1')
+        self.assertEqual(response.headers['Link'], link)
 
-    def test_list_scrum_stories(self):
-        story_eat = StoryDummy(**self.story_eat_kwargs)
-        story_eat.put()
-        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
-        scrum_story_eat.put()
+        response = self.testapp.get('/projects')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 2)
 
-        story_grow = StoryDummy(**self.story_grow_kwargs)
-        story_grow.put()
-        scrum_story_grow = ScrumStoryDummy(story=story_grow, **self.scrum_story_grow_kwargs)
-        scrum_story_grow.put()
+    def test_list_projects__invalidated_while_building(self):
+        """
+        Test that a list built from data a write has since invalidated is not cached as current.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
+        do_get = ProjectListOrCreateHandler.do_get.im_func
+        project_banana_kwargs = self.project_banana_kwargs
+        def racing_do_get(handler, *args, **kwargs):
+            result = list(do_get(handler, *args, **kwargs))
+            # Another request writes between this one's cache miss and its cache write.
+            ProjectDummy(**project_banana_kwargs).put()
+            cache.invalidate('ProjectDummy')
+            return result
+
+        ProjectListOrCreateHandler.do_get = racing_do_get
+        try:
+            response = self.testapp.get('/projects')
+        finally:
+            del ProjectListOrCreateHandler.do_get
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
 
-        story_throw = StoryDummy(**self.story_throw_kwargs)
-        story_throw.put()
-        scrum_story_throw = ScrumStoryDummy(story=story_throw, **self.scrum_story_throw_kwargs)
-        scrum_story_throw.put()
+        response = self.testapp.get('/projects')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 2)
 
-        response = self.testapp.get('/scrum/stories')
-        self.assertEqual(response.status_int, 200)
-        self.assertEqual(response.content_type, 'application/json')
+    def test_list_projects__invalidated_by_uncached_handler(self):
+        """
+        Test that a write through a handler that does not cache still invalidates lists cached by another.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        self.testapp.get('/projects')
 
-        scrum_story_dicts = appenginejson.loads(response.normal_body)
-        self.assertEqual(len(scrum_story_dicts), 3)
+        self.assertEqual(ProjectInstanceHandler.cache_ttl, None)
+        self.testapp.put_json('/projects/%s' % project_apple.key(), dict(self.project_apple_kwargs, name='Apricot'))
+        response = self.testapp.get('/projects')
+        self.assertEqual(appenginejson.loads(response.normal_body)[0]['name'], 'Apricot')
 
-        self.assertEqual(scrum_story_dicts[0]['key'], str(scrum_story_eat.key()))
-        self.assertEqualScrumStoryEatDict(scrum_story_dicts[0])
-        self.assertEqualStoryEatDict(scrum_story_dicts[0])
-        self.assertEqual(scrum_story_dicts[1]['key'], str(scrum_story_grow.key()))
-        self.assertEqualScrumStoryGrowDict(scrum_story_dicts[1])
-        self.assertEqualStoryGrowDict(scrum_story_dicts[1])
-        self.assertEqual(scrum_story_dicts[2]['key'], str(scrum_story_throw.key()))
-        self.assertEqualScrumStoryThrowDict(scrum_story_dicts[2])
-        self.assertEqualStoryThrowDict(scrum_story_dicts[2])
+    def test_cache__invalidate(self):
+        cache.set('ProjectDummy', 'key', 'value', 60)
+        self.assertEqual(cache.get('ProjectDummy', 'key'), 'value')
 
+        cache.invalidate('ProjectDummy')
+        self.assertEqual(cache.get('ProjectDummy', 'key'), None)
 
-class TestScrumStoryCreateHandler(BaseTestScrumStoryHandler):
+    def test_lru_cache__evicts_least_recently_used(self):
+        lru_cache = cache.LRUCache(max_size=2)
+        lru_cache.set('a', 1)
+        lru_cache.set('b', 2)
+        lru_cache.get('a')
+        lru_cache.set('c', 3)
+        self.assertEqual(lru_cache.get('a'), 1)
+        self.assertEqual(lru_cache.get('b'), None)
+        self.assertEqual(lru_cache.get('c'), 3)
 
-    def test_create_scrum_story(self):
-        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
 
-        response = self.testapp.post_json('/scrum/stories', scrum_story_eat_kwargs)
-        self.assertEqual(response.status_int, 201)
-        self.assertEqual(response.content_type, 'application/json')
+class TestProjectListOrCreateHandler__Coalesce(BaseTestHandler):
 
-        scrum_story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqualScrumStoryEatDict(scrum_story_dict)
-        self.assertEqualStoryEatDict(scrum_story_dict)
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Coalesce, self).setUp()
+        self._cache_ttl_orig = ProjectListOrCreateHandler.cache_ttl
+        self._coalesce_timeout_orig = ProjectListOrCreateHandler.coalesce_timeout
+        self._do_get_orig = ProjectListOrCreateHandler.__dict__.get('do_get')
+        ProjectListOrCreateHandler.cache_ttl = 60
+        ProjectListOrCreateHandler.coalesce_timeout = 5
 
-        scrum_story = ScrumStoryDummy.get(scrum_story_dict['key'])
-        self.assertEqualScrumStoryEat(scrum_story)
-        self.assertEqualStoryEat(scrum_story.story)
+    def tearDown(self):
+        ProjectListOrCreateHandler.cache_ttl = self._cache_ttl_orig
+        ProjectListOrCreateHandler.coalesce_timeout = self._coalesce_timeout_orig
+        if self._do_get_orig is None:
+            del ProjectListOrCreateHandler.do_get
+        else:
+            ProjectListOrCreateHandler.do_get = self._do_get_orig
+        super(TestProjectListOrCreateHandler__Coalesce, self).tearDown()
+
+    def count_do_get(self, delay=0):
+        calls = []
+        do_get = ProjectListOrCreateHandler.do_get.im_func
+        def counted_do_get(handler, *args, **kwargs):
+            calls.append(handler.request.path_qs)
+            time.sleep(delay)
+            return do_get(handler, *args, **kwargs)
+        ProjectListOrCreateHandler.do_get = counted_do_get
+        return calls
+
+    def test_list_projects__coalesced(self):
+        """
+        Test that concurrent identical cache misses build the response once and all get it.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
+        calls = self.count_do_get(delay=0.2)
+
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(self.testapp.get('/projects')))
+                   for i in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['/projects'])
+        self.assertEqual(len(responses), 5)
+        for response in responses:
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
+
+    def test_list_projects__coalesced_per_query_string(self):
+        calls = self.count_do_get(delay=0.2)
+
+        threads = [threading.Thread(target=self.testapp.get, args=(url,)) for url in ('/projects', '/projects?limit=1')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(calls), ['/projects', '/projects?limit=1'])
+
+    def test_list_projects__lease_held_elsewhere(self):
+        """
+        Test that a request waits out another instance's lease, then builds the response itself.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectListOrCreateHandler.coalesce_timeout = 0.2
+        calls = self.count_do_get()
 
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        self.assertTrue(cache.acquire_lease(handler.get_cache_namespace(), handler.get_cache_key(), 60))
 
-class TestScrumStoryGetHandler(BaseTestScrumStoryHandler):
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
+        self.assertEqual(calls, ['/projects'])
 
-    def test_get_scrum_story(self):
-        story_eat = StoryDummy(**self.story_eat_kwargs)
-        story_eat.put()
-        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
-        scrum_story_eat.put()
+    def test_list_projects__flight_stalled(self):
+        """
+        Test that a request whose wait on a stalled flight runs out takes the lease and builds the response, leaving
+        the stalled flight registered.
+        """
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectListOrCreateHandler.coalesce_timeout = 0.2
+        calls = self.count_do_get()
+
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        namespace, cache_key = handler.get_cache_namespace(), handler.get_cache_key()
+        leader, event = cache.single_flight.begin(cache_key)
+        self.assertTrue(leader)
+        leased = []
+        acquire_lease = cache.acquire_lease
+        def recorded_acquire_lease(*args):
+            leased.append(acquire_lease(*args))
+            return leased[-1]
+        cache.acquire_lease = recorded_acquire_lease
+        try:
+            response = self.testapp.get('/projects')
+            stalled = not event.is_set() and cache.single_flight.begin(cache_key) == (False, event)
+        finally:
+            cache.acquire_lease = acquire_lease
+            cache.single_flight.end(cache_key)
 
-        response = self.testapp.get('/scrum/stories/%s' % str(scrum_story_eat.key()))
         self.assertEqual(response.status_int, 200)
-        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
+        self.assertEqual(calls, ['/projects'])
+        self.assertEqual(leased, [True])
+        self.assertTrue(stalled)
+        self.assertTrue(cache.acquire_lease(namespace, cache_key, 60))
 
-        scrum_story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqual(scrum_story_dict['key'], str(scrum_story_eat.key()))
-        self.assertEqualScrumStoryEatDict(scrum_story_dict)
-        self.assertEqualStoryEatDict(scrum_story_dict)
+    def test_list_projects__lease_released(self):
+        self.testapp.get('/projects')
 
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        self.assertTrue(cache.acquire_lease(handler.get_cache_namespace(), handler.get_cache_key(), 60))
 
-class TestScrumStoryPutHandler(BaseTestScrumStoryHandler):
+    def test_single_flight(self):
+        leader, event = cache.single_flight.begin('key')
+        self.assertTrue(leader)
+        follower, followed_event = cache.single_flight.begin('key')
+        self.assertFalse(follower)
+        self.assertIs(followed_event, event)
 
-    def test_put_scrum_story(self):
-        story_eat = StoryDummy(**self.story_eat_kwargs)
-        story_eat.put()
-        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
-        scrum_story_eat.put()
+        cache.single_flight.end('key')
+        self.assertTrue(event.is_set())
+        self.assertTrue(cache.single_flight.begin('key')[0])
+        cache.single_flight.end('key')
 
-        scrum_story_grow_kwargs = dict(self.story_grow_kwargs.items() + self.scrum_story_grow_kwargs.items())
 
-        response = self.testapp.put_json('/scrum/stories/%s' % str(scrum_story_eat.key()), scrum_story_grow_kwargs)
+class TestProjectInstanceHandler__Conditional(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectInstanceHandler__Conditional, self).setUp()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.url = '/projects/%s' % str(self.project_apple.key())
+
+    def tearDown(self):
+        if 'check_if_match' in ProjectInstanceHandler.__dict__:
+            del ProjectInstanceHandler.check_if_match
+        super(TestProjectInstanceHandler__Conditional, self).tearDown()
+
+    def test_get_project__validators(self):
+        response = self.testapp.get(self.url)
         self.assertEqual(response.status_int, 200)
-        self.assertEqual(response.content_type, 'application/json')
+        self.assertTrue(response.headers.get('ETag'))
+        self.assertTrue(response.headers.get('Last-Modified'))
+        self.assertEqualProjectAppleDict(appenginejson.loads(response.normal_body))
 
-        scrum_story_dict = appenginejson.loads(response.normal_body)
-        self.assertEqualScrumStoryGrowDict(scrum_story_dict)
-        self.assertEqualStoryGrowDict(scrum_story_dict)
+    def test_get_project__if_none_match(self):
+        etag = self.testapp.get(self.url).headers['ETag']
 
-        scrum_story = ScrumStoryDummy.get(scrum_story_dict['key'])
-        self.assertEqualScrumStoryGrow(scrum_story)
-        self.assertEqualStoryGrow(scrum_story.story)
+        response = self.testapp.get(self.url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.normal_body, '')
+        self.assertEqual(response.headers['ETag'], etag)
 
-        self.assertEqual(ScrumStoryDummy.all().count(), 1)
-        self.assertEqual(StoryDummy.all().count(), 1)
+        response = self.testapp.get(self.url, headers={'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_int, 200)
 
+    def test_get_project__etag_per_representation(self):
+        """
+        Test that the ETag differs per selected fields and media type, so one representation's ETag never gets a
+        304 for another.
+        """
+        etag = self.testapp.get(self.url).headers['ETag']
 
-class TestScrumStoryDeleteHandler(BaseTestScrumStoryHandler):
+        response = self.testapp.get(self.url + '?fields=name', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
 
-    def test_delete_scrum_story(self):
-        story_eat = StoryDummy(**self.story_eat_kwargs)
-        story_eat.put()
-        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
-        scrum_story_eat.put()
+        response = self.testapp.get(self.url, headers={'If-None-Match': etag[:-1] + '-gzip"'})
+        self.assertEqual(response.status_int, 200)
 
-        response = self.testapp.delete('/scrum/stories/%s' % str(scrum_story_eat.key()))
-        self.assertEqual(response.status_int, 204)
-        self.assertEqual(response.content_type, None)
-        self.assertEqual(response.normal_body, '')
+    @unittest2.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_get_project__etag_per_media_type(self):
+        etag = self.testapp.get(self.url).headers['ETag']
 
-        self.assertEqual(ScrumStoryDummy.all().count(), 0)
-        self.assertEqual(StoryDummy.all().count(), 0)
+        response = self.testapp.get(self.url, headers={'Accept': MsgPackRenderer.media_type, 'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_get_project__if_modified_since(self):
+        last_modified = self.testapp.get(self.url).headers['Last-Modified']
+
+        response = self.testapp.get(self.url, headers={'If-Modified-Since': last_modified}, status=304)
+        self.assertEqual(response.status_int, 304)
+
+        response = self.testapp.get(self.url, headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_put_project__if_match(self):
+        etag = self.testapp.get(self.url).headers['ETag']
+
+        response = self.testapp.put_json(self.url, self.project_banana_kwargs, headers={'If-Match': '"stale"'},
+                                         status=412)
+        self.assertEqual(response.status_int, 412)
+        self.assertEqual(ProjectDummy.get(self.project_apple.key()).name, 'Apple')
+
+        response = self.testapp.put_json(self.url, self.project_banana_kwargs, headers={'If-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(ProjectDummy.get(self.project_apple.key()).name, 'Banana')
+
+        # The update changed the representation, so the old ETag no longer matches.
+        response = self.testapp.delete(self.url, headers={'If-Match': etag}, status=412)
+        self.assertEqual(response.status_int, 412)
+        self.assertEqual(ProjectDummy.all().count(), 1)
+
+    def race_if_match(self, **kwargs):
+        """
+        Make the next If-Match check pass, then write ``kwargs`` to the project behind the request's back.
+        """
+        check_if_match = ProjectInstanceHandler.check_if_match.im_func
+        project_apple_key = self.project_apple.key()
+        def concurrent_put():
+            project_apple = ProjectDummy.get(project_apple_key)
+            for name, value in kwargs.items():
+                setattr(project_apple, name, value)
+            project_apple.put()
+        def racing_check_if_match(handler, model_instance):
+            check_if_match(handler, model_instance)
+            del ProjectInstanceHandler.check_if_match
+            db.non_transactional(concurrent_put)()
+        ProjectInstanceHandler.check_if_match = racing_check_if_match
+
+    def test_put_project__if_match_changed_before_write(self):
+        """
+        Test that a write made between the If-Match check and the PUT fails the precondition on retry.
+        """
+        etag = self.testapp.get(self.url).headers['ETag']
+        self.race_if_match(name='Coconut')
+
+        response = self.testapp.put_json(self.url, self.project_banana_kwargs, headers={'If-Match': etag},
+                                         status=412)
+        self.assertEqual(response.status_int, 412)
+        self.assertEqual(ProjectDummy.get(self.project_apple.key()).name, 'Coconut')
+
+    def test_delete_project__if_match_changed_before_write(self):
+        etag = self.testapp.get(self.url).headers['ETag']
+        self.race_if_match(name='Coconut')
+
+        response = self.testapp.delete(self.url, headers={'If-Match': etag}, status=412)
+        self.assertEqual(response.status_int, 412)
+        self.assertEqual(ProjectDummy.get(self.project_apple.key()).name, 'Coconut')
+
+
+class TestProjectListHandler__Fields(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListHandler__Fields, self).setUp()
+        self._allowed_fields_orig = ProjectListOrCreateHandler.allowed_fields
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.allowed_fields = self._allowed_fields_orig
+        super(TestProjectListHandler__Fields, self).tearDown()
+
+    def test_list_projects__fields(self):
+        """
+        Test that only the requested fields (and the key) are returned.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        project_banana = ProjectDummy(**self.project_banana_kwargs)
+        project_banana.put()
+
+        response = self.testapp.get('/projects?fields=name')
+        self.assertEqual(response.status_int, 200)
+
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(project_dicts, [{'key': str(project_apple.key()), 'name': 'Apple'},
+                                         {'key': str(project_banana.key()), 'name': 'Banana'}])
+
+    def test_list_projects__fields_text_property(self):
+        ProjectDummy(**self.project_apple_kwargs).put()
+
+        response = self.testapp.get('/projects?fields=description,number')
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(sorted(project_dicts[0].keys()), ['description', 'key', 'number'])
+        self.assertEqual(project_dicts[0]['description'], 'The round fruit of a tree of the rose family.')
+
+    def test_list_projects__invalid_fields(self):
+        response = self.testapp.get('/projects?fields=name,colour', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_list_projects__allowed_fields(self):
+        ProjectListOrCreateHandler.allowed_fields = ('name',)
+
+        response = self.testapp.get('/projects?fields=name')
+        self.assertEqual(response.status_int, 200)
+
+        response = self.testapp.get('/projects?fields=number', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_get_projection(self):
+        """
+        Test that projection queries are only used for indexed, projectable properties.
+        """
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        self.assertEqual(handler.get_projection(set(['key', 'name'])), ['name', 'number'])
+        self.assertEqual(handler.get_projection(set(['name', 'description'])), None)
+        self.assertEqual(handler.get_projection(set(['key'])), None)
+        self.assertEqual(handler.get_projection(None), None)
+        self.assertEqual(handler.get_projection(set(['number']), [('name', '=', u'Apple')]), None)
+
+
+class TestProjectListHandler__Filters(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListHandler__Filters, self).setUp()
+        self.project_dewberry = ProjectDummy(**self.project_dewberry_kwargs)
+        self.project_dewberry.put()
+        self.project_coconut = ProjectDummy(**self.project_coconut_kwargs)
+        self.project_coconut.put()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.project_apple_too = ProjectDummy(**self.project_apple_too_kwargs)
+        self.project_apple_too.put()
+
+    def get_keys(self, url):
+        response = self.testapp.get(url)
+        self.assertEqual(response.status_int, 200)
+        return [project_dict['key'] for project_dict in appenginejson.loads(response.normal_body)]
+
+    def test_list_projects__filter_exact(self):
+        self.assertEqual(self.get_keys('/projects?name=Apple'),
+                         [str(self.project_apple.key()), str(self.project_apple_too.key())])
+
+    def test_list_projects__filter_inequality(self):
+        self.assertEqual(self.get_keys('/projects?number__gte=2'),
+                         [str(self.project_apple_too.key()), str(self.project_dewberry.key())])
+        self.assertEqual(self.get_keys('/projects?number__lt=2'),
+                         [str(self.project_apple.key()), str(self.project_coconut.key())])
+
+    def test_list_projects__filter_combined(self):
+        self.assertEqual(self.get_keys('/projects?number__gte=2&name=Apple'), [str(self.project_apple_too.key())])
+
+    def test_list_projects__filter_not_allowed(self):
+        response = self.testapp.get('/projects?name__gte=B', status=400)
+        self.assertEqual(response.status_int, 400)
+
+        response = self.testapp.get('/projects?description=Fruit', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_list_projects__filter_invalid_value(self):
+        response = self.testapp.get('/projects?number=one', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_list_projects__filter_inequality_descending(self):
+        """
+        Test that a declared descending order on the inequality property keeps its direction.
+        """
+        class DescendingProjectListHandler(ProjectListOrCreateHandler):
+            order_by = ('name', 'number DESC')
+
+        handler = DescendingProjectListHandler(webapp2.Request.blank('/projects?number__gte=1'), webapp2.Response())
+        filters = handler.get_filters()
+        self.assertEqual(handler.get_order_by(filters), ('number DESC', 'name'))
+        self.assertEqual([project.key() for project in handler.do_get()],
+                         [self.project_apple_too.key(), self.project_dewberry.key(), self.project_apple.key(),
+                          self.project_coconut.key()])
+        self.assertTrue(('ProjectDummy', False, (('number', 'desc'), ('name', 'asc')))
+                        in get_indexes(DescendingProjectListHandler))
+
+    def test_list_stories__without_filter_fields(self):
+        """
+        Test that query parameters named like properties are ignored by handlers without filter_fields.
+        """
+        StoryDummy(parent=self.project_apple, **self.story_eat_kwargs).put()
+        StoryDummy(parent=self.project_apple, **self.story_grow_kwargs).put()
+
+        response = self.testapp.get('/projects/%s/stories?number=1&title=Other' % self.project_apple.key())
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 2)
+
+    def test_get_indexes(self):
+        self.assertEqual(get_indexes(ProjectListOrCreateHandler), [
+            ('ProjectDummy', False, (('number', 'asc'), ('name', 'asc'))),
+            ('ProjectDummy', False, (('name', 'asc'), ('number', 'asc'))),
+        ])
+        self.assertEqual(get_indexes(StoryListOrCreateHandler), [
+            ('StoryDummy', True, (('number', 'asc'),)),
+        ])
+        self.assertEqual(index_yaml([StoryListOrCreateHandler]),
+                         'indexes:\n\n- kind: StoryDummy\n  ancestor: yes\n  properties:\n  - name: number\n')
+
+    def test_get_indexes__exact_and_inequality(self):
+        """
+        Test that an exact filter combined with an inequality filter gets an index on both.
+        """
+        class FilteredProjectListHandler(ProjectListOrCreateHandler):
+            filter_fields = {'name': ('exact',), 'number': ('gte',)}
+            order_by = ()
+
+        self.assertEqual(get_indexes(FilteredProjectListHandler), [
+            ('ProjectDummy', False, (('name', 'asc'), ('number', 'asc'))),
+        ])
+
+        FilteredProjectListHandler.order_by = ('updated',)
+        self.assertTrue(('ProjectDummy', False, (('name', 'asc'), ('number', 'asc'), ('updated', 'asc')))
+                        in get_indexes(FilteredProjectListHandler))
+
+
+class TestProjectListHandler__Plans(BaseTestHandler):
+
+    def test_query_template__reused(self):
+        """
+        Test that the compiled query is reused across requests and only its arguments are rebound.
+        """
+        handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        other_handler = ProjectListOrCreateHandler(webapp2.Request.blank('/projects'), webapp2.Response())
+        filters = [('number', '=', 1)]
+
+        self.assertTrue(handler.get_query_template() is other_handler.get_query_template())
+        self.assertTrue(handler.get_query_template(None, filters) is
+                        other_handler.get_query_template(None, [('number', '=', 2)]))
+        self.assertFalse(handler.get_query_template() is handler.get_query_template(None, filters))
+
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectDummy(**self.project_banana_kwargs).put()
+        self.assertEqual([project.name for project in handler.get_query(None, None, filters)], ['Apple'])
+        self.assertEqual([project.name for project in handler.get_query(None, None, [('number', '=', 2)])],
+                         ['Banana'])
+
+    def test_schema(self):
+        schema = get_schema(ScrumStoryDummy)
+        self.assertTrue(schema is get_schema(ScrumStoryDummy))
+        self.assertEqual((schema.plain_prop_names, schema.reference_prop_names), (('status',), ('story',)))
+        self.assertEqual([(reference_name, sorted(prop_names))
+                          for reference_name, prop_names in schema.get_flatten_layout(('story',))],
+                         [(None, ['status']), ('story', ['number', 'title'])])
+        self.assertTrue(schema.get_flatten_layout(('story',)) is schema.get_flatten_layout(('story',)))
+
+
+class TestModelJsonEncoder(BaseTestHandler):
+
+    def test_dumps__same_as_appenginejson(self):
+        """
+        Test that the fast path encodes the same documents as appenginejson.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        project_banana = ProjectDummy(**self.project_banana_kwargs)
+        project_banana.put()
+        payload = [project_apple, {'name': project_banana.name, 'owner': project_banana.owner},
+                   None, True, 1.5, u'\u00e9']
+
+        self.assertEqual(appenginejson.loads(ModelJsonEncoder.dumps(payload)),
+                         appenginejson.loads(appenginejson.dumps(payload)))
+
+    def test_list_projects__named_encoder(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+
+        encoder_orig = ProjectListOrCreateHandler.encoder
+        ProjectListOrCreateHandler.encoder = 'model'
+        try:
+            response = self.testapp.get('/projects')
+        finally:
+            ProjectListOrCreateHandler.encoder = encoder_orig
+        self.assertEqual(appenginejson.loads(response.normal_body),
+                         appenginejson.loads(self.testapp.get('/projects').normal_body))
+
+        project_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(project_dicts[0]['key'], str(project_apple.key()))
+        self.assertEqualProjectAppleDict(project_dicts[0])
+
+    def test_codecs__preferred_by_default(self):
+        self.assertIs(get_encoder(), AppEngineJsonEncoder)
+        self.assertIs(get_encoder('model'), ModelJsonEncoder)
+        self.assertIs(get_decoder(), simplejson.loads if simplejson else json.loads)
+        self.assertIs(get_decoder('json'), json.loads)
+
+
+class TestProjectListOrCreateHandler__BodySize(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__BodySize, self).setUp()
+        self._max_body_size_orig = ProjectListOrCreateHandler.max_body_size
+        self._stream_threshold_orig = JsonParser.stream_threshold
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.max_body_size = self._max_body_size_orig
+        JsonParser.stream_threshold = self._stream_threshold_orig
+        super(TestProjectListOrCreateHandler__BodySize, self).tearDown()
+
+    def test_create_project__body_too_large(self):
+        ProjectListOrCreateHandler.max_body_size = 64
+
+        response = self.testapp.post_json('/projects', self.project_dewberry_kwargs, status=413)
+        self.assertEqual(response.status_int, 413)
+        self.assertEqual(ProjectDummy.all().count(), 0)
+
+        response = self.testapp.post_json('/projects', {'number': 1, 'name': 'Apple'})
+        self.assertEqual(response.status_int, 201)
+
+    def test_create_project__invalid_json(self):
+        response = self.testapp.post('/projects', '{"number": 1,', content_type='application/json', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_bulk_create_projects__streamed(self):
+        """
+        Test that a large JSON array is decoded element by element from the body file.
+        """
+        JsonParser.stream_threshold = 0
+
+        response = self.testapp.post_json('/projects', [self.project_apple_kwargs, self.project_banana_kwargs])
+        self.assertEqual(response.status_int, 207)
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [201, 201])
+        self.assertEqual(ProjectDummy.all().count(), 2)
+
+    def test_bulk_create_projects__streamed_invalid(self):
+        """
+        Test that a streamed body found invalid after some batches were written reports their statuses and the error.
+        """
+        JsonParser.stream_threshold = 0
+        bulk_batch_size_orig = ProjectListOrCreateHandler.bulk_batch_size
+        ProjectListOrCreateHandler.bulk_batch_size = 1
+        try:
+            body = appenginejson.dumps([self.project_apple_kwargs, self.project_banana_kwargs])[:-1] + ', {"number":'
+            response = self.testapp.post('/projects', body, content_type='application/json')
+        finally:
+            ProjectListOrCreateHandler.bulk_batch_size = bulk_batch_size_orig
+        self.assertEqual(response.status_int, 207)
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [201, 201, 400])
+        self.assertEqual(statuses[-1]['error'], 'Invalid JSON')
+        self.assertEqual(ProjectDummy.all().count(), 2)
+
+    def test_json_array_iterator(self):
+        body = '[1, {"a": [2, 3]}, "x,]", 1.5e10, true, null]'
+        self.assertEqual(list(JsonArrayIterator(StringIO(body), chunk_size=3)),
+                         [1, {'a': [2, 3]}, 'x,]', 1.5e10, True, None])
+        self.assertEqual(list(JsonArrayIterator(StringIO(' [ ] '), chunk_size=1)), [])
+
+        self.assertRaises(Http4xx, list, JsonArrayIterator(StringIO('[1, 2'), chunk_size=3))
+        self.assertRaises(Http4xx, list, JsonArrayIterator(StringIO('[1, 2, 3, 4]'), max_body_size=6))
+
+
+class TestProjectListOrCreateHandler__Renderers(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Renderers, self).setUp()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.project_banana = ProjectDummy(**self.project_banana_kwargs)
+        self.project_banana.put()
+
+    def test_list_projects__default_json(self):
+        response = self.testapp.get('/projects', headers={'Accept': 'text/html,*/*;q=0.8'})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 2)
+
+    def test_list_projects__columnar(self):
+        """
+        Test that the columnar renderer sends property names once and one row per project.
+        """
+        response = self.testapp.get('/projects?fields=name,number',
+                                    headers={'Accept': ColumnarJsonRenderer.media_type})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, ColumnarJsonRenderer.media_type)
+
+        content = appenginejson.loads(response.normal_body)
+        self.assertEqual(content['columns'], ['key', 'name', 'number'])
+        self.assertEqual(content['rows'], [[str(self.project_apple.key()), 'Apple', 1],
+                                           [str(self.project_banana.key()), 'Banana', 2]])
+
+    def test_bulk_create_projects__columnar_falls_back(self):
+        """
+        Test that bulk statuses, whose keys differ per item, are rendered as JSON even if columns are preferred.
+        """
+        response = self.testapp.post_json('/projects', [self.project_coconut_kwargs, 'Durian'],
+                                          headers={'Accept': ColumnarJsonRenderer.media_type})
+        self.assertEqual(response.status_int, 207)
+        self.assertEqual(response.content_type, 'application/json')
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [201, 400])
+        self.assertTrue('key' in statuses[0])
+        self.assertTrue('error' in statuses[1])
+
+    def test_list_projects__columnar_empty(self):
+        db.delete([self.project_apple, self.project_banana])
+
+        response = self.testapp.get('/projects', headers={'Accept': ColumnarJsonRenderer.media_type})
+        self.assertEqual(appenginejson.loads(response.normal_body), {'columns': [], 'rows': []})
+
+    @unittest2.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_list_projects__msgpack(self):
+        response = self.testapp.get('/projects', headers={'Accept': MsgPackRenderer.media_type})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, MsgPackRenderer.media_type)
+
+        project_dicts = msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(project_dicts[0]['key'], str(self.project_apple.key()))
+        self.assertEqualProjectAppleDict(project_dicts[0])
+
+    @unittest2.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_create_project__msgpack(self):
+        response = self.testapp.post('/projects', msgpack.packb(self.project_coconut_kwargs, use_bin_type=True),
+                                     content_type='application/x-msgpack')
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(ProjectDummy.all().filter('name =', 'Coconut').count(), 1)
+
+    def test_create_project__unsupported_content_type(self):
+        response = self.testapp.post('/projects', 'name=Coconut', content_type='text/plain', status=415)
+        self.assertEqual(response.status_int, 415)
+
+
+class TestProjectListOrCreateHandler__Compression(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Compression, self).setUp()
+        self._compress_threshold_orig = ProjectListOrCreateHandler.compress_threshold
+        self._cache_ttl_orig = ProjectListOrCreateHandler.cache_ttl
+        ProjectListOrCreateHandler.compress_threshold = 200
+
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectDummy(**self.project_banana_kwargs).put()
+        ProjectDummy(**self.project_coconut_kwargs).put()
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.compress_threshold = self._compress_threshold_orig
+        ProjectListOrCreateHandler.cache_ttl = self._cache_ttl_orig
+        super(TestProjectListOrCreateHandler__Compression, self).tearDown()
+
+    def test_list_projects__gzip(self):
+        response = self.testapp.get('/projects', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue('Accept-Encoding' in response.headers['Vary'])
+
+        project_dicts = appenginejson.loads(zlib.decompress(response.body, 16 + zlib.MAX_WBITS))
+        self.assertEqual(len(project_dicts), 3)
+        self.assertEqualProjectAppleDict(project_dicts[0])
+
+    def test_list_projects__deflate(self):
+        response = self.testapp.get('/projects', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(len(appenginejson.loads(zlib.decompress(response.body))), 3)
+
+    def test_list_projects__not_accepted(self):
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 3)
+
+        response = self.testapp.get('/projects', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+
+    def test_list_projects__below_threshold(self):
+        response = self.testapp.get('/projects?fields=number&limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 1)
+
+    def test_list_projects__cached_gzip(self):
+        """
+        Test that a cached compressed body is served as is, and identity clients get their own entry.
+        """
+        ProjectListOrCreateHandler.cache_ttl = 60
+
+        first = self.testapp.get('/projects', headers={'Accept-Encoding': 'gzip'})
+        second = self.testapp.get('/projects', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(second.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(len(appenginejson.loads(zlib.decompress(second.body, 16 + zlib.MAX_WBITS))), 3)
+
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.headers.get('Content-Encoding'), None)
+        self.assertEqual(len(appenginejson.loads(response.normal_body)), 3)
+
+
+class TestProjectListOrCreateHandler__Profiling(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Profiling, self).setUp()
+        self._profile_hooks_orig = ProjectListOrCreateHandler.profile_hooks
+        self.profiles = []
+        ProjectListOrCreateHandler.profile_hooks = (profiling.server_timing_hook,
+                                                    lambda handler, profile: self.profiles.append(profile))
+
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.profile_hooks = self._profile_hooks_orig
+        super(TestProjectListOrCreateHandler__Profiling, self).tearDown()
+
+    def test_count_rpcs(self):
+        profile = profiling.start()
+        db.get(self.project_apple.key())
+        ProjectDummy(**self.project_banana_kwargs).put()
+        profiling.stop()
+        self.assertEqual(profile.rpcs, {'datastore_v3': 2})
+
+        db.get(self.project_apple.key())
+        self.assertEqual(profile.rpcs, {'datastore_v3': 2})
+
+    def test_list_projects(self):
+        response = self.testapp.get('/projects')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(len(appenginejson.loads(response.body)), 1)
+
+        profile = self.profiles[0]
+        self.assertEqual(profile.timings.keys(), ['do_method', 'serialize', 'write'])
+        self.assertTrue(profile.rpcs['datastore_v3'] >= 1)
+
+        server_timing = response.headers['Server-Timing']
+        self.assertTrue(server_timing.startswith('do_method;dur='))
+        self.assertTrue('datastore_v3;desc="%d RPCs"' % profile.rpcs['datastore_v3'] in server_timing)
+
+    def test_create_project(self):
+        response = self.testapp.post_json('/projects', self.project_banana_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(self.profiles[0].timings.keys(), ['parse', 'do_method', 'serialize', 'write'])
+        self.assertTrue(response.headers['Server-Timing'].startswith('parse;dur='))
+
+    def test_error(self):
+        response = self.testapp.get('/projects?limit=abc', status=400)
+        self.assertEqual(self.profiles[0].timings.keys(), ['do_method'])
+        self.assertTrue('Server-Timing' in response.headers)
+
+    def test_disabled(self):
+        ProjectListOrCreateHandler.profile_hooks = ()
+        response = self.testapp.get('/projects')
+        self.assertFalse('Server-Timing' in response.headers)
+        self.assertEqual(self.profiles, [])
+
+
+class TestProjectListHandler__Count(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListHandler__Count, self).setUp()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        ProjectDummy(**self.project_banana_kwargs).put()
+        ProjectDummy(**self.project_coconut_kwargs).put()
+
+    def test_count_projects(self):
+        response = self.testapp.get('/projects?count=true')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(appenginejson.loads(response.body), {'count': 3})
+
+    def test_count_projects__filtered(self):
+        response = self.testapp.get('/projects?count=true&number=1')
+        self.assertEqual(appenginejson.loads(response.body), {'count': 2})
+
+        response = self.testapp.get('/projects?count=true&name=Durian')
+        self.assertEqual(appenginejson.loads(response.body), {'count': 0})
+
+    def test_aggregate_projects(self):
+        response = self.testapp.get('/projects?aggregate=number__sum,number__min,number__max')
+        self.assertEqual(appenginejson.loads(response.body),
+                         {'count': 3, 'number__sum': 4, 'number__min': 1, 'number__max': 2})
+
+        response = self.testapp.get('/projects?aggregate=number__sum,number__max&number__gt=1')
+        self.assertEqual(appenginejson.loads(response.body), {'count': 1, 'number__sum': 2, 'number__max': 2})
+
+        response = self.testapp.get('/projects?aggregate=number__sum&name=Durian')
+        self.assertEqual(appenginejson.loads(response.body), {'count': 0, 'number__sum': None})
+
+    def test_aggregate_projects__invalid(self):
+        response = self.testapp.get('/projects?aggregate=name__sum', status=400)
+        self.assertEqual(appenginejson.loads(response.body), 'Invalid aggregate: name__sum')
+
+        response = self.testapp.get('/projects?aggregate=number__avg', status=400)
+        self.assertEqual(response.status_int, 400)
+
+    def test_head_projects(self):
+        response = self.testapp.head('/projects?number=1')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers['X-Total-Count'], '2')
+        self.assertEqual(response.body, '')
+
+    def test_count_stories(self):
+        StoryDummy(parent=self.project_apple, **self.story_eat_kwargs).put()
+        StoryDummy(parent=self.project_apple, **self.story_grow_kwargs).put()
+        StoryDummy(**self.story_throw_kwargs).put()
+
+        response = self.testapp.get('/projects/%s/stories?count=true' % self.project_apple.key())
+        self.assertEqual(appenginejson.loads(response.body), {'count': 2})
+
+        response = self.testapp.head('/projects/%s/stories' % self.project_apple.key())
+        self.assertEqual(response.headers['X-Total-Count'], '2')
+
+        missing_key = db.Key.from_path('ProjectDummy', 9999)
+        self.testapp.get('/projects/%s/stories?count=true' % missing_key, status=404)
+
+
+class TestProjectListOrCreateHandler__Delete(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Delete, self).setUp()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.project_banana = ProjectDummy(**self.project_banana_kwargs)
+        self.project_banana.put()
+        ProjectDummy(**self.project_coconut_kwargs).put()
+
+    def test_delete_project(self):
+        """
+        Test that deleting a project without expanded properties is a single datastore RPC.
+        """
+        profile = profiling.start()
+        response = self.testapp.delete('/projects/%s' % self.project_apple.key())
+        profiling.stop()
+        self.assertEqual(response.status_int, 204)
+        self.assertEqual(profile.rpcs, {'datastore_v3': 1})
+        self.assertEqual(ProjectDummy.get(self.project_apple.key()), None)
+
+    def test_delete_project__missing(self):
+        self.project_apple.delete()
+        response = self.testapp.delete('/projects/%s' % self.project_apple.key())
+        self.assertEqual(response.status_int, 204)
+
+    def test_delete_project__wrong_kind(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        self.testapp.delete('/projects/%s' % story_eat.key(), status=404)
+        self.testapp.delete('/projects/abc', status=404)
+        self.assertEqual(StoryDummy.all().count(), 1)
+
+    def test_clear_projects(self):
+        response = self.testapp.delete('/projects')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 3})
+        self.assertFalse('Link' in response.headers)
+        self.assertEqual(ProjectDummy.all().count(), 0)
+
+    def test_clear_projects__not_allowed(self):
+        ProjectListOrCreateHandler.allow_clear = False
+        try:
+            response = self.testapp.delete('/projects', status=405)
+        finally:
+            ProjectListOrCreateHandler.allow_clear = True
+        self.assertEqual(response.status_int, 405)
+        self.assertEqual(ProjectDummy.all().count(), 3)
+
+    def test_clear_projects__filtered(self):
+        response = self.testapp.delete('/projects?number=1')
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 2})
+        self.assertEqual([project.name for project in ProjectDummy.all()], ['Banana'])
+
+    def test_clear_projects__resumable(self):
+        response = self.testapp.delete('/projects?limit=2')
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 2})
+        self.assertEqual(ProjectDummy.all().count(), 1)
+
+        link = response.headers['Link']
+        response = self.testapp.delete(link[1:link.index('>')])
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 1})
+        self.assertFalse('Link' in response.headers)
+        self.assertEqual(ProjectDummy.all().count(), 0)
+
+    def test_clear_stories(self):
+        StoryDummy(parent=self.project_apple, **self.story_eat_kwargs).put()
+        StoryDummy(parent=self.project_apple, **self.story_grow_kwargs).put()
+        StoryDummy(parent=self.project_banana, **self.story_throw_kwargs).put()
+
+        response = self.testapp.delete('/projects/%s/stories' % self.project_apple.key())
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 2})
+        self.assertEqual([story.title for story in StoryDummy.all()], [self.story_throw_kwargs['title']])
+
+    def test_bulk_delete_stories__scoped(self):
+        """
+        Test that bulk writes under a parent answer 404 for another parent's entities and for a missing parent.
+        """
+        story_eat = StoryDummy(parent=self.project_apple, **self.story_eat_kwargs)
+        story_eat.put()
+        story_throw = StoryDummy(parent=self.project_banana, **self.story_throw_kwargs)
+        story_throw.put()
+        url = '/projects/%s/stories' % self.project_apple.key()
+
+        response = self.testapp.put_json(url, [dict(self.story_throw_kwargs, key=str(story_throw.key()), number=9)])
+        self.assertEqual([status['status'] for status in appenginejson.loads(response.body)], [404])
+        self.assertEqual(StoryDummy.get(story_throw.key()).number, self.story_throw_kwargs['number'])
+
+        response = self.testapp.request(url, method='DELETE', content_type='application/json',
+                                        body=appenginejson.dumps([str(story_eat.key()), str(story_throw.key())]))
+        self.assertEqual([status['status'] for status in appenginejson.loads(response.body)], [204, 404])
+        self.assertEqual([story.title for story in StoryDummy.all()], [self.story_throw_kwargs['title']])
+
+        missing_key = db.Key.from_path('ProjectDummy', 'missing')
+        response = self.testapp.request('/projects/%s/stories' % missing_key, method='DELETE', status=404,
+                                        content_type='application/json',
+                                        body=appenginejson.dumps([str(story_throw.key())]))
+        self.assertEqual(response.status_int, 404)
+        self.assertEqual(StoryDummy.all().count(), 1)
+
+
+class TestProjectListOrCreateHandler__Deferred(BaseTestHandler):
+
+    def setUp(self):
+        super(TestProjectListOrCreateHandler__Deferred, self).setUp()
+        self._deferred_methods_orig = ProjectListOrCreateHandler.deferred_methods
+        ProjectListOrCreateHandler.deferred_methods = ('do_bulk_post', 'do_put', 'do_clear')
+
+    def tearDown(self):
+        ProjectListOrCreateHandler.deferred_methods = self._deferred_methods_orig
+        super(TestProjectListOrCreateHandler__Deferred, self).tearDown()
+
+    def test_bulk_create_projects(self):
+        response = self.testapp.post_json('/projects', [self.project_apple_kwargs, self.project_banana_kwargs])
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(appenginejson.loads(response.body)['state'], 'pending')
+        self.assertEqual(ProjectDummy.all().count(), 0)
+
+        status_url = response.headers['Location']
+        self.run_tasks()
+        self.assertEqual(ProjectDummy.all().count(), 2)
+
+        status_dict = appenginejson.loads(self.testapp.get(status_url).body)
+        self.assertEqual(status_dict['state'], 'done')
+        self.assertEqual(status_dict['result']['status'], 207)
+        self.assertEqual([status['status'] for status in status_dict['result']['body']], [201, 201])
+
+    def test_create_project(self):
+        """
+        Test that single creates stay in the request when only bulk creates are deferred.
+        """
+        response = self.testapp.post_json('/projects', self.project_apple_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(ProjectDummy.all().count(), 1)
+
+    def test_clear_projects(self):
+        ProjectDummy(**self.project_apple_kwargs).put()
+        ProjectDummy(**self.project_banana_kwargs).put()
+
+        response = self.testapp.delete('/projects?number=1')
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(ProjectDummy.all().count(), 2)
+
+        self.run_tasks()
+        self.assertEqual([project.name for project in ProjectDummy.all()], ['Banana'])
+        status_dict = appenginejson.loads(self.testapp.get(response.headers['Location']).body)
+        self.assertEqual(status_dict['result'], {'status': 200, 'body': {'deleted': 1}})
+
+    def test_bulk_create_projects__invalid(self):
+        response = self.testapp.post_json('/projects', [{'number': 'one', 'name': 'Apple'}])
+        self.run_tasks()
+        status_dict = appenginejson.loads(self.testapp.get(response.headers['Location']).body)
+        self.assertEqual(status_dict['state'], 'done')
+        self.assertEqual(status_dict['result']['body'][0]['status'], 400)
+
+        self.testapp.get('/tasks/%s' % db.Key.from_path('TaskStatus', 9999), status=404)
+
+    def test_clear_projects__failed(self):
+        response = self.testapp.delete('/projects?limit=1&cursor=bogus')
+        self.assertEqual(response.status_int, 202)
+
+        self.run_tasks()
+        status_dict = appenginejson.loads(self.testapp.get(response.headers['Location']).body)
+        self.assertEqual(status_dict['state'], 'failed')
+        self.assertEqual(status_dict['status_code'], 400)
+        self.assertEqual(status_dict['error'], 'Invalid cursor')
+
+    def test_invalid_requests__not_deferred(self):
+        """
+        Test that requests failing cheap validation get their 4xx at once instead of a task.
+        """
+        response = self.testapp.put_json('/projects', self.project_apple_kwargs, status=400)
+        self.assertEqual(appenginejson.loads(response.body), 'Expected a list')
+        self.testapp.delete('/projects?name__gt=Apple', status=400)
+        self.testapp.delete('/projects?limit=0', status=400)
+        self.assertEqual(self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME).get_filtered_tasks(), [])
+
+
+class TestStoryListHandler(BaseTestHandler):
+
+    def test_list_stories(self):
+        """
+        Test that returned stories are order by number.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        story_throw = StoryDummy(parent=project_apple, **self.story_throw_kwargs)
+        story_throw.put()
+        story_eat = StoryDummy(parent=project_apple, **self.story_eat_kwargs)
+        story_eat.put()
+        story_grow = StoryDummy(parent=project_apple, **self.story_grow_kwargs)
+        story_grow.put()
+
+        response = self.testapp.get('/projects/%s/stories' % str(project_apple.key()))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+
+        story_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(story_dicts), 3)
+
+        self.assertEqual(story_dicts[0]['key'], str(story_eat.key()))
+        self.assertEqualStoryEatDict(story_dicts[0])
+        self.assertEqual(story_dicts[1]['key'], str(story_grow.key()))
+        self.assertEqualStoryGrowDict(story_dicts[1])
+        self.assertEqual(story_dicts[2]['key'], str(story_throw.key()))
+        self.assertEqualStoryThrowDict(story_dicts[2])
+
+
+    def test_list_stories__missing_project(self):
+        missing_key = db.Key.from_path('ProjectDummy', 12345)
+        response = self.testapp.get('/projects/%s/stories' % str(missing_key), status=404)
+        self.assertEqual(response.status_int, 404)
+
+    def test_list_stories__wrong_kind(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        response = self.testapp.get('/projects/%s/stories' % str(story_eat.key()), status=404)
+        self.assertEqual(response.status_int, 404)
+
+
+class TestShardedStoryListOrCreateHandler(BaseTestHandler):
+
+    def setUp(self):
+        super(TestShardedStoryListOrCreateHandler, self).setUp()
+        self.project_apple = ProjectDummy(**self.project_apple_kwargs)
+        self.project_apple.put()
+        self.project_banana = ProjectDummy(**self.project_banana_kwargs)
+        self.project_banana.put()
+
+        handler = ShardedStoryListOrCreateHandler(webapp2.Request.blank('/'), webapp2.Response())
+        self.shard_keys = handler.get_scope_keys(self.project_apple.key())
+        # Numbers interleave across the shards so that listing them in order requires a merge.
+        for number in xrange(10):
+            ShardedStoryDummy(parent=self.shard_keys[number % len(self.shard_keys)], project=self.project_apple,
+                              number=number, title='Story %d' % number).put()
+        ShardedStoryDummy(parent=handler.get_scope_keys(self.project_banana.key())[0], project=self.project_banana,
+                          number=0, title='Banana story').put()
+        self.url = '/projects/%s/sharded-stories' % self.project_apple.key()
+
+    def test_scope_keys(self):
+        self.assertEqual(len(set(self.shard_keys)), 4)
+        self.assertTrue(all(shard_key.parent() is None for shard_key in self.shard_keys))
+
+    def test_create_story(self):
+        random.seed(0)
+        keys = [appenginejson.loads(self.testapp.post_json(self.url, {'number': 10 + i, 'title': 'New'}).body)['key']
+                for i in xrange(8)]
+        stories = ShardedStoryDummy.get(keys)
+        self.assertTrue(len(set(story.parent_key() for story in stories)) > 1)
+        self.assertTrue(all(story.parent_key() in self.shard_keys for story in stories))
+        self.assertTrue(all(story.project.key() == self.project_apple.key() for story in stories))
+
+    def test_bulk_create_stories(self):
+        """
+        Test that each item of a bulk create picks its own shard.
+        """
+        random.seed(0)
+        response = self.testapp.post_json(self.url, [{'number': 10 + i, 'title': 'New'} for i in xrange(8)])
+        stories = ShardedStoryDummy.get([status['key'] for status in appenginejson.loads(response.body)])
+        self.assertTrue(len(set(story.parent_key() for story in stories)) > 1)
+        self.assertTrue(all(story.parent_key() in self.shard_keys for story in stories))
+
+    def test_list_stories(self):
+        response = self.testapp.get(self.url)
+        self.assertEqual([story_dict['number'] for story_dict in appenginejson.loads(response.body)], range(10))
+
+        response = self.testapp.get(self.url + '?number__gte=7')
+        self.assertEqual([story_dict['number'] for story_dict in appenginejson.loads(response.body)], [7, 8, 9])
+
+    def get_pages(self, url):
+        story_dicts = []
+        while url:
+            response = self.testapp.get(url)
+            story_dicts.extend(appenginejson.loads(response.body))
+            link = response.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        return story_dicts
+
+    def test_list_stories__pagination(self):
+        story_dicts = self.get_pages(self.url + '?limit=3')
+        self.assertEqual([story_dict['number'] for story_dict in story_dicts], range(10))
+
+        # Projection queries page with cursors from the projection queries themselves.
+        story_dicts = self.get_pages(self.url + '?limit=3&fields=number')
+        self.assertEqual([story_dict['number'] for story_dict in story_dicts], range(10))
+
+        self.testapp.get(self.url + '?limit=3&cursor=abc', status=400)
+
+    def test_list_stories__pagination_ties(self):
+        """
+        Test that stories with equal sort values are merged in key order and paged without gaps or repeats.
+        """
+        keys = [ShardedStoryDummy(parent=shard_key, project=self.project_apple, number=100, title='Tie').put()
+                for shard_key in self.shard_keys * 2]
+
+        story_dicts = self.get_pages(self.url + '?number__gte=100&limit=3')
+        self.assertEqual([story_dict['key'] for story_dict in story_dicts], [str(key) for key in sorted(keys)])
+
+    def test_count_and_clear_stories(self):
+        response = self.testapp.get(self.url + '?count=true')
+        self.assertEqual(appenginejson.loads(response.body), {'count': 10})
+
+        response = self.testapp.delete(self.url)
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 10})
+        self.assertEqual([story.title for story in ShardedStoryDummy.all()], ['Banana story'])
+
+
+class TestStoryCreateHandler(BaseTestHandler):
+
+    def test_create_story__missing_project(self):
+        missing_key = db.Key.from_path('ProjectDummy', 12345)
+        response = self.testapp.post_json('/projects/%s/stories' % str(missing_key), self.story_eat_kwargs,
+                                          status=404)
+        self.assertEqual(response.status_int, 404)
+        self.assertEqual(StoryDummy.all().count(), 0)
+
+    def test_create_story(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+
+        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+
+        story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqualStoryEatDict(story_dict)
+
+        story = StoryDummy.get(story_dict['key'])
+        self.assertEqualStoryEat(story)
+
+    def test_create_story__blank_number(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        self.story_eat_kwargs['number'] = ''
+
+        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+
+        story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(story_dict['number'], None)
+        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+
+        story = StoryDummy.get(story_dict['key'])
+        self.assertEqual(story.number, None)
+        self.assertEqual(story.title, 'Eat an apple a day')
+
+    def test_create_story__none_number(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        self.story_eat_kwargs['number'] = None
+
+        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+
+        story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(story_dict['number'], None)
+        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+
+        story = StoryDummy.get(story_dict['key'])
+        self.assertEqual(story.number, None)
+        self.assertEqual(story.title, 'Eat an apple a day')
+
+    def test_create_story__missing_number(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        del self.story_eat_kwargs['number']
+
+        response = self.testapp.post_json('/projects/%s/stories' % str(project_apple.key()), self.story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+
+        story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(story_dict['number'], None)
+        self.assertEqual(story_dict['title'], 'Eat an apple a day')
+
+        story = StoryDummy.get(story_dict['key'])
+        self.assertEqual(story.number, None)
+        self.assertEqual(story.title, 'Eat an apple a day')
+
+
+class BaseTestScrumStoryHandler(BaseTestHandler):
+
+    def setUp(self):
+        super(BaseTestScrumStoryHandler, self).setUp()
+
+        self.scrum_story_eat_kwargs = {
+            'status': 'ToDo'
+        }
+        self.scrum_story_grow_kwargs = {
+            'status': 'Complete'
+        }
+        self.scrum_story_throw_kwargs = {
+            'status': 'InProgress'
+        }
+
+    def assertEqualScrumStoryEatDict(self, scrum_story_dict):
+        self.assertEqual(scrum_story_dict['status'], 'ToDo')
+
+    def assertEqualScrumStoryGrowDict(self, scrum_story_dict):
+        self.assertEqual(scrum_story_dict['status'], 'Complete')
+
+    def assertEqualScrumStoryThrowDict(self, scrum_story_dict):
+        self.assertEqual(scrum_story_dict['status'], 'InProgress')
+
+    def assertEqualScrumStoryEat(self, scrum_story):
+        self.assertEqual(scrum_story.status, 'ToDo')
+
+    def assertEqualScrumStoryGrow(self, scrum_story):
+        self.assertEqual(scrum_story.status, 'Complete')
+
+
+class TestScrumStoryListHandler(BaseTestScrumStoryHandler):
+
+    def test_list_scrum_stories(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        story_grow = StoryDummy(**self.story_grow_kwargs)
+        story_grow.put()
+        scrum_story_grow = ScrumStoryDummy(story=story_grow, **self.scrum_story_grow_kwargs)
+        scrum_story_grow.put()
+
+        story_throw = StoryDummy(**self.story_throw_kwargs)
+        story_throw.put()
+        scrum_story_throw = ScrumStoryDummy(story=story_throw, **self.scrum_story_throw_kwargs)
+        scrum_story_throw.put()
+
+        response = self.testapp.get('/scrum/stories')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+
+        scrum_story_dicts = appenginejson.loads(response.normal_body)
+        self.assertEqual(len(scrum_story_dicts), 3)
+
+        self.assertEqual(scrum_story_dicts[0]['key'], str(scrum_story_eat.key()))
+        self.assertEqualScrumStoryEatDict(scrum_story_dicts[0])
+        self.assertEqualStoryEatDict(scrum_story_dicts[0])
+        self.assertEqual(scrum_story_dicts[1]['key'], str(scrum_story_grow.key()))
+        self.assertEqualScrumStoryGrowDict(scrum_story_dicts[1])
+        self.assertEqualStoryGrowDict(scrum_story_dicts[1])
+        self.assertEqual(scrum_story_dicts[2]['key'], str(scrum_story_throw.key()))
+        self.assertEqualScrumStoryThrowDict(scrum_story_dicts[2])
+        self.assertEqualStoryThrowDict(scrum_story_dicts[2])
+
+
+class TestPrefetchReferences(BaseTestScrumStoryHandler):
+
+    def test_prefetch_references(self):
+        """
+        Test that referenced instances are resolved by one batch get and cached on the instances.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        story_grow = StoryDummy(**self.story_grow_kwargs)
+        story_grow.put()
+        ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs).put()
+        ScrumStoryDummy(story=story_grow, **self.scrum_story_grow_kwargs).put()
+        ScrumStoryDummy(story=story_grow, **self.scrum_story_throw_kwargs).put()
+
+        scrum_stories = prefetch_references(ScrumStoryDummy.all().fetch(10), ('story',))
+
+        # Referenced stories are no longer in the datastore, so they must come from the prefetch.
+        db.delete([story_eat, story_grow])
+        self.assertEqual(len(scrum_stories), 3)
+        self.assertEqual(sorted(scrum_story.story.title for scrum_story in scrum_stories),
+                         ['Eat an apple a day', 'Grow an apple a day', 'Grow an apple a day'])
+
+
+class TestScrumStoryCreateHandler(BaseTestScrumStoryHandler):
+
+    def test_create_scrum_story(self):
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+
+        response = self.testapp.post_json('/scrum/stories', scrum_story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        self.assertEqual(response.content_type, 'application/json')
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqualScrumStoryEatDict(scrum_story_dict)
+        self.assertEqualStoryEatDict(scrum_story_dict)
+
+        scrum_story = ScrumStoryDummy.get(scrum_story_dict['key'])
+        self.assertEqualScrumStoryEat(scrum_story)
+        self.assertEqualStoryEat(scrum_story.story)
+
+    def test_allocate_keys(self):
+        """
+        Test that allocated keys are complete and unique so they can be referenced before put.
+        """
+        story_key, other_story_key, scrum_story_key = allocate_keys([StoryDummy, StoryDummy, ScrumStoryDummy])
+        self.assertTrue(story_key.has_id_or_name())
+        self.assertEqual(story_key.kind(), 'StoryDummy')
+        self.assertNotEqual(story_key, other_story_key)
+        self.assertEqual(scrum_story_key.kind(), 'ScrumStoryDummy')
+
+
+class TestScrumStoryGetHandler(BaseTestScrumStoryHandler):
+
+    def test_get_scrum_story(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.testapp.get('/scrum/stories/%s' % str(scrum_story_eat.key()))
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(scrum_story_dict['key'], str(scrum_story_eat.key()))
+        self.assertEqualScrumStoryEatDict(scrum_story_dict)
+        self.assertEqualStoryEatDict(scrum_story_dict)
+
+
+class TestScrumStoryGetHandler__Conditional(BaseTestScrumStoryHandler):
+
+    def setUp(self):
+        super(TestScrumStoryGetHandler__Conditional, self).setUp()
+        self._use_etags_orig = ScrumStoryInstanceHandler.use_etags
+        ScrumStoryInstanceHandler.use_etags = True
+
+    def tearDown(self):
+        ScrumStoryInstanceHandler.use_etags = self._use_etags_orig
+        super(TestScrumStoryGetHandler__Conditional, self).tearDown()
+
+    def test_get_scrum_story__if_none_match(self):
+        """
+        Test that the ETag of an expanded resource is computed from its payload.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+        url = '/scrum/stories/%s' % str(scrum_story_eat.key())
+
+        response = self.testapp.get(url)
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers.get('Last-Modified'), None)
+
+        response = self.testapp.get(url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(response.status_int, 304)
+
+        story_eat.title = 'Eat two apples a day'
+        story_eat.put()
+        response = self.testapp.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class TestScrumStoryGetHandler__Fields(BaseTestScrumStoryHandler):
+
+    def test_get_scrum_story__fields(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.testapp.get('/scrum/stories/%s?fields=status,title' % str(scrum_story_eat.key()))
+        self.assertEqual(response.status_int, 200)
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(scrum_story_dict, {'key': str(scrum_story_eat.key()), 'status': 'ToDo',
+                                            'title': 'Eat an apple a day'})
+
+
+class TestScrumStoryPutHandler(BaseTestScrumStoryHandler):
+
+    def test_put_scrum_story(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        scrum_story_grow_kwargs = dict(self.story_grow_kwargs.items() + self.scrum_story_grow_kwargs.items())
+
+        response = self.testapp.put_json('/scrum/stories/%s' % str(scrum_story_eat.key()), scrum_story_grow_kwargs)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqualScrumStoryGrowDict(scrum_story_dict)
+        self.assertEqualStoryGrowDict(scrum_story_dict)
+
+        scrum_story = ScrumStoryDummy.get(scrum_story_dict['key'])
+        self.assertEqualScrumStoryGrow(scrum_story)
+        self.assertEqualStoryGrow(scrum_story.story)
+
+        self.assertEqual(ScrumStoryDummy.all().count(), 1)
+        self.assertEqual(StoryDummy.all().count(), 1)
+
+
+class TestScrumStoryPatchHandler(BaseTestScrumStoryHandler):
+
+    def patch_json(self, url, content, status=None):
+        return self.testapp.request(url, method='PATCH', body=appenginejson.dumps(content),
+                                    content_type='application/json', status=status)
+
+    def test_patch_scrum_story(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.patch_json('/scrum/stories/%s' % scrum_story_eat.key(), {'status': 'Done'})
+        self.assertEqual(response.status_int, 200)
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(scrum_story_dict['status'], 'Done')
+        self.assertEqualStoryEatDict(scrum_story_dict)
+
+        scrum_story = ScrumStoryDummy.get(scrum_story_eat.key())
+        self.assertEqual(scrum_story.status, 'Done')
+        self.assertEqualStoryEat(scrum_story.story)
+
+    def test_patch_scrum_story__expanded(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.patch_json('/scrum/stories/%s' % scrum_story_eat.key(), {'number': '7'})
+        self.assertEqual(appenginejson.loads(response.normal_body)['number'], 7)
+        self.assertEqual(StoryDummy.get(story_eat.key()).number, 7)
+        self.assertEqual(ScrumStoryDummy.get(scrum_story_eat.key()).status, self.scrum_story_eat_kwargs['status'])
+
+    def test_patch_project__unchanged(self):
+        """
+        Test that a patch that changes nothing reads the entity without writing it back.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+
+        profile = profiling.start()
+        response = self.patch_json('/projects/%s' % project_apple.key(), {'name': 'Apple', 'number': 1})
+        profiling.stop()
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(profile.rpcs, {'datastore_v3': 1})
+        self.assertEqual(ProjectDummy.get(project_apple.key()).updated, project_apple.updated)
+
+    def test_patch_project__invalid(self):
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+
+        response = self.patch_json('/projects/%s' % project_apple.key(), {'number': 'one'}, status=400)
+        self.assertEqual(appenginejson.loads(response.body), 'Invalid value for field: number')
+        self.patch_json('/projects/%s' % project_apple.key(), {'name': None}, status=400)
+        self.patch_json('/projects/%s' % project_apple.key(), ['Apple'], status=400)
+        project = ProjectDummy.get(project_apple.key())
+        self.assertEqual((project.number, project.name), (1, 'Apple'))
+
+        self.patch_json('/projects/%s' % db.Key.from_path('ProjectDummy', 9999), {'name': 'Durian'}, status=404)
+
+    def test_patch_project__cleaned_like_put(self):
+        """
+        Test that PATCH stores a value exactly as PUT does, since both clean it the same way.
+        """
+        project_apple = ProjectDummy(**self.project_apple_kwargs)
+        project_apple.put()
+        url = '/projects/%s' % project_apple.key()
+
+        for number in ('7', 8):
+            self.testapp.put_json(url, dict(self.project_apple_kwargs, number=number))
+            put_number = ProjectDummy.get(project_apple.key()).number
+            self.patch_json(url, {'number': 1})
+            self.patch_json(url, {'number': number})
+            self.assertEqual(ProjectDummy.get(project_apple.key()).number, put_number)
+
+
+class TestScrumStoryDeleteHandler(BaseTestScrumStoryHandler):
+
+    def test_delete_scrum_story(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.testapp.delete('/scrum/stories/%s' % str(scrum_story_eat.key()))
+        self.assertEqual(response.status_int, 204)
+        self.assertEqual(response.content_type, None)
+        self.assertEqual(response.normal_body, '')
+
+        self.assertEqual(ScrumStoryDummy.all().count(), 0)
+        self.assertEqual(StoryDummy.all().count(), 0)
+
+
+    def test_delete_scrum_story__not_found(self):
+        missing_key = db.Key.from_path('ScrumStoryDummy', 9999)
+        response = self.testapp.delete('/scrum/stories/%s' % missing_key, status=404)
+        self.assertEqual(response.status_int, 404)
+
+    def test_clear_scrum_stories(self):
+        for story_kwargs, scrum_story_kwargs in ((self.story_eat_kwargs, self.scrum_story_eat_kwargs),
+                                                 (self.story_grow_kwargs, self.scrum_story_grow_kwargs)):
+            story = StoryDummy(**story_kwargs)
+            story.put()
+            ScrumStoryDummy(story=story, **scrum_story_kwargs).put()
+
+        response = self.testapp.delete('/scrum/stories')
+        self.assertEqual(appenginejson.loads(response.body), {'deleted': 2})
+        self.assertEqual(ScrumStoryDummy.all().count(), 0)
+        self.assertEqual(StoryDummy.all().count(), 0)
+
+    def test_delete_scrum_story__deferred_cascade(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        ScrumStoryInstanceHandler.defer_cascades = True
+        try:
+            response = self.testapp.delete('/scrum/stories/%s' % scrum_story_eat.key())
+        finally:
+            ScrumStoryInstanceHandler.defer_cascades = False
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(ScrumStoryDummy.all().count(), 0)
+        self.assertEqual(StoryDummy.all().count(), 1)
+
+        self.run_tasks()
+        self.assertEqual(StoryDummy.all().count(), 0)
+        self.assertEqual(appenginejson.loads(self.testapp.get(response.headers['Location']).body)['state'], 'done')
+
+    def test_delete_scrum_story__deferred_cascade_invalidates(self):
+        """
+        Test that a deferred cascade invalidates the cache again once the references are deleted.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        ScrumStoryInstanceHandler.defer_cascades = True
+        ScrumStoryInstanceHandler.cache_ttl = 60
+        try:
+            self.testapp.delete('/scrum/stories/%s' % scrum_story_eat.key())
+        finally:
+            ScrumStoryInstanceHandler.defer_cascades = False
+            ScrumStoryInstanceHandler.cache_ttl = None
+        generation = cache.get_generation('StoryDummy')
+
+        self.run_tasks()
+        self.assertNotEqual(cache.get_generation('StoryDummy'), generation)
+
+    def test_list_scrum_stories__invalidated_by_expanded_kind(self):
+        """
+        Test that cached responses flattening an expanded kind are invalidated by writes to that kind.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs).put()
+
+        ScrumStoryListOrCreateHandler.cache_ttl = 60
+        try:
+            self.testapp.get('/scrum/stories')
+            story_eat.title = 'Eat a pear a day'
+            story_eat.put()
+            # As a write through a Story handler would.
+            cache.invalidate('StoryDummy')
+            response = self.testapp.get('/scrum/stories')
+        finally:
+            ScrumStoryListOrCreateHandler.cache_ttl = None
+        self.assertEqual(appenginejson.loads(response.normal_body)[0]['title'], 'Eat a pear a day')
+
+    def test_patch_scrum_story__deferred_if_match(self):
+        """
+        Test that a deferred method sees the original request's headers and records its 4xx.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        ScrumStoryInstanceHandler.deferred_methods = ('do_patch',)
+        try:
+            response = self.testapp.request('/scrum/stories/%s' % scrum_story_eat.key(), method='PATCH',
+                                            body=appenginejson.dumps({'status': 'Done'}),
+                                            content_type='application/json', headers={'If-Match': '"stale"'})
+            self.testapp.request('/scrum/stories/%s' % scrum_story_eat.key(), method='PATCH',
+                                 body=appenginejson.dumps(['Done']), content_type='application/json', status=400)
+        finally:
+            ScrumStoryInstanceHandler.deferred_methods = ()
+        self.assertEqual(response.status_int, 202)
+
+        self.run_tasks()
+        status_dict = appenginejson.loads(self.testapp.get(response.headers['Location']).body)
+        self.assertEqual(status_dict['state'], 'failed')
+        self.assertEqual(status_dict['status_code'], 412)
+        self.assertEqual(ScrumStoryDummy.get(scrum_story_eat.key()).status, self.scrum_story_eat_kwargs['status'])
+
+class TestScrumStoryListOrCreateHandler__Bulk(BaseTestScrumStoryHandler):
+
+    def test_bulk_create_scrum_stories(self):
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        scrum_story_grow_kwargs = dict(self.story_grow_kwargs.items() + self.scrum_story_grow_kwargs.items())
+
+        response = self.testapp.post_json('/scrum/stories', [scrum_story_eat_kwargs, scrum_story_grow_kwargs])
+        self.assertEqual(response.status_int, 207)
+
+        statuses = appenginejson.loads(response.normal_body)
+        self.assertEqual([status['status'] for status in statuses], [201, 201])
+        self.assertEqualStoryEat(ScrumStoryDummy.get(statuses[0]['key']).story)
+        self.assertEqualStoryGrow(ScrumStoryDummy.get(statuses[1]['key']).story)
+        self.assertEqual(StoryDummy.all().count(), 2)
+
+    def test_bulk_create_scrum_stories__transactional(self):
+        """
+        Test that transactional bulk writes are batched within the entity group limit of a transaction.
+        """
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        ScrumStoryListOrCreateHandler.transactional = True
+        try:
+            response = self.testapp.post_json('/scrum/stories', [scrum_story_eat_kwargs] * 30)
+            self.assertEqual(response.status_int, 207)
+            statuses = appenginejson.loads(response.normal_body)
+            self.assertEqual([status['status'] for status in statuses], [201] * 30)
+
+            response = self.testapp.put_json('/scrum/stories', [dict(scrum_story_eat_kwargs, key=status['key'],
+                                                                     status='Done') for status in statuses])
+            self.assertEqual([status['status'] for status in appenginejson.loads(response.normal_body)],
+                             [200] * 30)
+        finally:
+            ScrumStoryListOrCreateHandler.transactional = False
+        self.assertEqual(ScrumStoryDummy.all().filter('status =', 'Done').count(), 30)
+
+    def test_bulk_delete_scrum_stories(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+
+        response = self.testapp.request('/scrum/stories', method='DELETE', content_type='application/json',
+                                        body=appenginejson.dumps([str(scrum_story_eat.key())]))
+        self.assertEqual(response.status_int, 207)
+
+        self.assertEqual(ScrumStoryDummy.all().count(), 0)
+        self.assertEqual(StoryDummy.all().count(), 0)
+
+
+class TestEmbeddedScrumStoryHandler(BaseTestScrumStoryHandler):
+
+    def test_create_and_get_scrum_story(self):
+        """
+        Test that an embedded story is written with its snapshot and read back in a single datastore RPC.
+        """
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        response = self.testapp.post_json('/embedded/stories', scrum_story_eat_kwargs)
+        self.assertEqual(response.status_int, 201)
+        key = appenginejson.loads(response.normal_body)['key']
+
+        scrum_story = EmbeddedScrumStoryDummy.get(key)
+        self.assertEqualStoryEat(scrum_story.story_snapshot)
+        self.assertEqual(scrum_story.story_snapshot.key(), scrum_story.story.key())
+
+        profile = profiling.start()
+        response = self.testapp.get('/embedded/stories/%s' % key)
+        profiling.stop()
+        self.assertEqual(profile.rpcs, {'datastore_v3': 1})
+
+        scrum_story_dict = appenginejson.loads(response.normal_body)
+        self.assertEqual(scrum_story_dict['key'], key)
+        self.assertEqualScrumStoryEatDict(scrum_story_dict)
+        self.assertEqualStoryEatDict(scrum_story_dict)
+        self.assertFalse('story_snapshot' in scrum_story_dict)
+
+    def test_list_scrum_stories(self):
+        for story_kwargs, scrum_story_kwargs in ((self.story_eat_kwargs, self.scrum_story_eat_kwargs),
+                                                 (self.story_grow_kwargs, self.scrum_story_grow_kwargs)):
+            self.testapp.post_json('/embedded/stories', dict(story_kwargs.items() + scrum_story_kwargs.items()))
+
+        response = self.testapp.get('/embedded/stories')
+        scrum_story_dicts = sorted(appenginejson.loads(response.normal_body), key=lambda item: item['number'])
+        self.assertEqual(len(scrum_story_dicts), 2)
+        self.assertEqualStoryEatDict(scrum_story_dicts[0])
+        self.assertEqualStoryGrowDict(scrum_story_dicts[1])
+
+    def test_patch_scrum_story(self):
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        response = self.testapp.post_json('/embedded/stories', scrum_story_eat_kwargs)
+        key = appenginejson.loads(response.normal_body)['key']
+
+        self.testapp.request('/embedded/stories/%s' % key, method='PATCH', content_type='application/json',
+                             body=appenginejson.dumps({'title': 'Grow an apple a day'}))
+        self.assertEqual(EmbeddedScrumStoryDummy.get(key).story_snapshot.title, 'Grow an apple a day')
+
+    def test_sync_snapshots(self):
+        """
+        Test that a story written through another handler refreshes its snapshots in a deferred task.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+        embedded_scrum_story_eat = EmbeddedScrumStoryDummy(story=story_eat, story_snapshot=story_eat,
+                                                           **self.scrum_story_eat_kwargs)
+        embedded_scrum_story_eat.put()
+
+        scrum_story_grow_kwargs = dict(self.story_grow_kwargs.items() + self.scrum_story_grow_kwargs.items())
+        self.testapp.put_json('/scrum/stories/%s' % scrum_story_eat.key(), scrum_story_grow_kwargs)
+
+        url = '/embedded/stories/%s' % embedded_scrum_story_eat.key()
+        self.assertEqualStoryEatDict(appenginejson.loads(self.testapp.get(url).normal_body))
+        self.run_tasks()
+        self.assertEqualStoryGrowDict(appenginejson.loads(self.testapp.get(url).normal_body))
+
+    def get_tasks(self):
+        return self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME).get_filtered_tasks()
+
+    def test_sync_snapshots__only_when_referenced_elsewhere(self):
+        """
+        Test that writes made through the embedded handler, which refresh the only snapshot themselves, and
+        creates, which nothing references yet, queue no sync.
+        """
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        response = self.testapp.post_json('/embedded/stories', scrum_story_eat_kwargs)
+        key = appenginejson.loads(response.normal_body)['key']
+        self.assertEqual(self.get_tasks(), [])
+
+        scrum_story_grow_kwargs = dict(self.story_grow_kwargs.items() + self.scrum_story_grow_kwargs.items())
+        self.testapp.put_json('/embedded/stories/%s' % key, scrum_story_grow_kwargs)
+        self.testapp.request('/embedded/stories/%s' % key, method='PATCH', content_type='application/json',
+                             body=appenginejson.dumps({'title': 'Grow an apple a day'}))
+        self.assertEqual(self.get_tasks(), [])
+        self.assertEqual(EmbeddedScrumStoryDummy.get(key).story_snapshot.title, 'Grow an apple a day')
+
+    def test_sync_snapshots__unchanged(self):
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+        EmbeddedScrumStoryDummy(story=story_eat, story_snapshot=story_eat, **self.scrum_story_eat_kwargs).put()
+
+        scrum_story_eat_kwargs = dict(self.story_eat_kwargs.items() + self.scrum_story_eat_kwargs.items())
+        self.testapp.put_json('/scrum/stories/%s' % scrum_story_eat.key(), scrum_story_eat_kwargs)
+        self.assertEqual(self.get_tasks(), [])
+
+    def test_sync_snapshots__deleted(self):
+        """
+        Test that deleting a referenced story clears the snapshots kept of it.
+        """
+        story_eat = StoryDummy(**self.story_eat_kwargs)
+        story_eat.put()
+        scrum_story_eat = ScrumStoryDummy(story=story_eat, **self.scrum_story_eat_kwargs)
+        scrum_story_eat.put()
+        embedded_scrum_story_eat = EmbeddedScrumStoryDummy(story=story_eat, story_snapshot=story_eat,
+                                                           **self.scrum_story_eat_kwargs)
+        embedded_scrum_story_eat.put()
+
+        self.testapp.delete('/scrum/stories/%s' % scrum_story_eat.key())
+        self.run_tasks()
+        self.assertEqual(EmbeddedScrumStoryDummy.get(embedded_scrum_story_eat.key()).story_snapshot, None)
@@ -1,12 +1,21 @@
 import webapp2
 
-from appengineserene.tests.handlers import (ProjectListOrCreateHandler, StoryListOrCreateHandler,
-                                   ScrumStoryListOrCreateHandler, ScrumStoryInstanceHandler)
+from appengineserene.handlers import TaskStatusHandler
+from appengineserene.tests.handlers import (ProjectListOrCreateHandler, ProjectInstanceHandler,
+                                   StoryListOrCreateHandler, ShardedStoryListOrCreateHandler,
+                                   ScrumStoryListOrCreateHandler, ScrumStoryInstanceHandler,
+                                   EmbeddedScrumStoryListOrCreateHandler, EmbeddedScrumStoryInstanceHandler)
 
 
 app = webapp2.WSGIApplication([
     webapp2.Route(r'/projects<:/?>', handler=ProjectListOrCreateHandler),
     webapp2.Route(r'/projects/<parent_key>/stories<:/?>', handler=StoryListOrCreateHandler),
+    webapp2.Route(r'/projects/<parent_key>/sharded-stories<:/?>', handler=ShardedStoryListOrCreateHandler),
+    webapp2.Route(r'/projects/<key><:/?>', handler=ProjectInstanceHandler),
     webapp2.Route(r'/scrum/stories<:/?>', handler=ScrumStoryListOrCreateHandler),
     webapp2.Route(r'/scrum/stories/<key><:/?>', handler=ScrumStoryInstanceHandler),
-], debug=True)
\ No newline at end of file
+    webapp2.Route(r'/embedded/stories<:/?>', handler=EmbeddedScrumStoryListOrCreateHandler),
+    webapp2.Route(r'/embedded/stories/<key><:/?>', handler=EmbeddedScrumStoryInstanceHandler),
+    webapp2.Route(r'/tasks/<key>', handler=TaskStatusHandler, name='task-status'),
+], debug=True)
+app.allowed_methods = webapp2.WSGIApplication.allowed_methods.union(['PATCH'])
\ No newline at end of file
@@ -1,19 +1,208 @@
+import heapq
+from datetime import datetime
+from functools import total_ordering
+from itertools import islice
+
 from google.appengine.ext import db
 
-def to_dict(model_instance, recursive=False):
+import appenginejson
+
+from appengineserene.properties import SnapshotProperty
+
+schemas = {}
+
+
+class ModelSchema(object):
+    """Property names of a model class, plus the flatten layouts built for it.
+    """
+    __slots__ = ('properties', 'plain_prop_names', 'reference_prop_names', 'flatten_layouts')
+
+    def __init__(self, model_class):
+        self.properties = model_class.properties()
+        # Snapshots are storage for expanded references, not part of the representation.
+        self.plain_prop_names = tuple(prop_name for prop_name, prop in self.properties.items()
+                                      if not isinstance(prop, (db.ReferenceProperty, SnapshotProperty)))
+        self.reference_prop_names = tuple(prop_name for prop_name, prop in self.properties.items()
+                                          if isinstance(prop, db.ReferenceProperty))
+        self.flatten_layouts = {}
+
+    def get_flatten_layout(self, flatten_keys):
+        """Return ((reference prop name or None for the instance itself, prop names), ...) in which every output
+        name appears once: the instance's own properties win, then earlier flatten keys win over later ones.
+        """
+        layout = self.flatten_layouts.get(flatten_keys)
+        if layout is None:
+            prop_names = tuple(prop_name for prop_name in self.plain_prop_names + self.reference_prop_names
+                               if prop_name not in flatten_keys)
+            claimed = set(('key',) + prop_names)
+            layout = [(None, prop_names)]
+            for key in flatten_keys:
+                schema = get_schema(self.properties[key].reference_class)
+                prop_names = tuple(prop_name for prop_name in schema.plain_prop_names + schema.reference_prop_names
+                                   if prop_name not in claimed)
+                claimed.update(prop_names)
+                layout.append((key, prop_names))
+            layout = self.flatten_layouts[flatten_keys] = tuple(layout)
+        return layout
+
+
+class Registry(object):
+    """Implementations registered by name, each with a priority; the highest priority one is the default.
+    """
+    def __init__(self):
+        self.items = {}
+        self.priorities = {}
+
+    def register(self, name, item, priority=0):
+        self.items[name] = item
+        self.priorities[name] = priority
+
+    def deregister(self, name):
+        del self.items[name]
+        del self.priorities[name]
+
+    def get(self, name=None):
+        if name is None:
+            name = max(self.items, key=self.priorities.get)
+        return self.items[name]
+
+
+def get_schema(model_class):
+    schema = schemas.get(model_class)
+    if schema is None:
+        schema = schemas[model_class] = ModelSchema(model_class)
+    return schema
+
+def to_dict(model_instance, recursive=False, fields=None):
     dictionary = {'key': unicode(model_instance.key())}
-    for key, prop in model_instance.properties().items():
-        value = getattr(model_instance, key)
-        if isinstance(prop, db.ReferenceProperty):
+    schema = get_schema(model_instance.__class__)
+    for key in schema.plain_prop_names:
+        if fields is None or key in fields:
+            dictionary[key] = getattr(model_instance, key)
+    for key in schema.reference_prop_names:
+        if fields is None or key in fields:
+            value = getattr(model_instance, key)
             dictionary[key] = to_dict(value) if recursive else value
-        else:
-            dictionary[key] = value
     return dictionary
 
-def flatten_to_dict(model_instance, flatten_keys):
-    model_instance_dict = to_dict(model_instance)
-    dictionary = {}
-    for key in reversed(flatten_keys):
-        dictionary.update(to_dict(model_instance_dict.pop(key)))
-    dictionary.update(model_instance_dict)
-    return dictionary
\ No newline at end of file
+def flatten_to_dict(model_instance, flatten_keys, fields=None):
+    """Merge the expanded references into one dict, writing each output name once from its winning source.
+    """
+    dictionary = {'key': unicode(model_instance.key())}
+    for reference_name, prop_names in get_schema(model_instance.__class__).get_flatten_layout(tuple(flatten_keys)):
+        source = model_instance if reference_name is None else getattr(model_instance, reference_name)
+        if source is None:
+            continue
+        for prop_name in prop_names:
+            if fields is None or prop_name in fields:
+                dictionary[prop_name] = getattr(source, prop_name)
+    return dictionary
+
+def dumps_iter(iterable, dumps=appenginejson.dumps):
+    yield '['
+    separator = ''
+    for item in iterable:
+        yield separator + dumps(item)
+        separator = ','
+    yield ']'
+
+def prefetch_references(model_instances, prop_names):
+    references = []
+    for model_instance in model_instances:
+        properties = model_instance.properties()
+        for prop_name in prop_names:
+            prop = properties[prop_name]
+            key = prop.get_value_for_datastore(model_instance)
+            if key is not None:
+                references.append((model_instance, prop, key))
+
+    keys = list(set(key for model_instance, prop, key in references))
+    referenced_instances = dict(zip(keys, db.get(keys))) if keys else {}
+    for model_instance, prop, key in references:
+        referenced_instance = referenced_instances[key]
+        if referenced_instance is not None:
+            prop.__set__(model_instance, referenced_instance)
+    return model_instances
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
+def iter_prefetched(model_instances, prop_names, batch_size):
+    for batch in iter_batches(model_instances, batch_size):
+        for model_instance in prefetch_references(batch, prop_names):
+            yield model_instance
+
+def allocate_keys(models):
+    counts = {}
+    for model in models:
+        counts[model.kind()] = counts.get(model.kind(), 0) + 1
+    rpcs = dict((kind, db.allocate_ids_async(db.Key.from_path(kind, 1), count)) for kind, count in counts.items())
+    ids = {}
+    for kind, rpc in rpcs.items():
+        start, end = rpc.get_result()
+        ids[kind] = iter(xrange(start, end + 1))
+    return [db.Key.from_path(model.kind(), next(ids[model.kind()])) for model in models]
+
+def coerce_value(prop, value):
+    if isinstance(value, basestring) and not issubclass(prop.data_type, basestring):
+        if value == '':
+            value = None
+        elif isinstance(prop, db.ReferenceProperty):
+            value = db.Key(value)
+        elif prop.data_type is bool:
+            if value.lower() not in ('true', 'false', '1', '0'):
+                raise ValueError('Invalid boolean: %s' % value)
+            value = value.lower() in ('true', '1')
+        elif prop.data_type is datetime:
+            value = datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+        else:
+            value = prop.data_type(value)
+    if value is None:
+        return None
+    return prop.validate(value)
+
+
+@total_ordering
+class Descending(object):
+    """Sort key wrapper that inverts the order of ``value``.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def get_sort_key(order_by):
+    """Build a sort key for model instances from GQL sort orders like ('number', 'name DESC').
+
+    Ties are broken by key, as the datastore does, so merged shards come out in the order one query would give.
+    """
+    orders = tuple((order.split()[0], order.upper().endswith(' DESC')) for order in order_by)
+    def sort_key(model_instance):
+        values = ((getattr(model_instance, prop_name), descending) for prop_name, descending in orders)
+        return tuple(Descending(value) if descending else value for value, descending in values) + \
+            (model_instance.key(),)
+    return sort_key
+
+def merge_sorted(iterables, sort_key, counts=None):
+    """Lazily merge iterables that are each sorted by ``sort_key``, tallying in ``counts`` how many items
+    were taken from each.
+    """
+    def decorate(index, iterable):
+        for item in iterable:
+            yield sort_key(item), index, item
+    for _, index, item in heapq.merge(*[decorate(index, iterable) for index, iterable in enumerate(iterables)]):
+        if counts is not None:
+            counts[index] += 1
+        yield item